@@ -1,7 +1,100 @@
+from array import array
+
+class Token:
+    TEXTS = ("number", "null", "true", "false", "name", "$EOF",
+             "var", "set", "if", "elif", "else", "while", "then", "for", "break", "continue", "def", "return",
+             "print", "func", "{", "}", "(", ")", ";", ",", "=", "?", ":", "|", "&", "#", "<", "<=", ">", ">=",
+             "+", "-", "*", "/", "^")
+    (NUMBER, NULL, TRUE, FALSE, NAME, EOF,
+     VAR, SET, IF, ELIF, ELSE, WHILE, THEN, FOR, BREAK, CONTINUE, DEF, RETURN,
+     PRINT, FUNC, LBRACE, RBRACE, LPAREN, RPAREN, SEMICOLON, COMMA, EQ, QUESTION, COLON, OR, AND, NE, LT, LE, GT, GE,
+     PLUS, MINUS, STAR, SLASH, CARET) = range(len(TEXTS))
+    VALUES = (None, None, True, False, None, *TEXTS[EOF:])
+    KINDS = {"null": NULL, "true": TRUE, "false": FALSE} | dict(zip(TEXTS[EOF:], range(EOF, len(TEXTS))))
+
+class TokenStream:
+    # Tokens as parallel columns: kind, start offset and length in source.
+    # Names and numbers keep their values in literals, keyed by token index;
+    # every other kind has a fixed value. The last token is always EOF.
+
+    __slots__ = ("source", "kinds", "starts", "lengths", "literals")
+
+    def __init__(self, source):
+        self.source = source
+        self.kinds, self.starts, self.lengths = array("i"), array("i"), array("i")
+        self.literals = {}
+
+    def __len__(self): return len(self.kinds)
+
+    def append(self, start, length, value):
+        if type(value) is str: kind = Token.KINDS.get(value, Token.NAME)
+        elif type(value) is int: kind = Token.NUMBER
+        else: kind = Token.NULL if value is None else Token.TRUE if value else Token.FALSE
+        if kind == Token.NAME or kind == Token.NUMBER: self.literals[len(self.kinds)] = value
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def value(self, index):
+        kind = self.kinds[index]
+        if kind == Token.NAME or kind == Token.NUMBER: return self.literals[index]
+        return Token.VALUES[kind]
+
 class Scanner:
+    # scan() takes a string or a text file. A file is read in chunks cut
+    # after their last line break; no token or comment spans one, so each
+    # piece scans on its own and the whole text is never held at once.
+    # scan_chunks() yields the tokens of each piece as it is read, with a
+    # last piece holding only EOF. A file that cannot seek, like a pipe, is
+    # read by lines so that what has arrived can run. next_token() works on
+    # strings only.
+
+    CHUNK_SIZE = 1 << 20
+
     def __init__(self, source) -> None:
         self._source = source
         self._current_position = 0
+        self._token_start = 0
+
+    def scan(self):
+        tokens, end = TokenStream(self._source), 0
+        for scanner in self._scanners():
+            scanner._scan_into(tokens, end)
+            end += len(scanner._source)
+        tokens.append(end, 0, "$EOF")
+        return tokens
+
+    def scan_chunks(self):
+        end = 0
+        for scanner in self._scanners():
+            tokens = TokenStream(scanner._source)
+            scanner._scan_into(tokens, end)
+            end += len(scanner._source)
+            yield tokens
+        tokens = TokenStream("")
+        tokens.append(end, 0, "$EOF")
+        yield tokens
+
+    def _scanners(self):
+        return [self] if isinstance(self._source, str) else map(type(self), self._chunks())
+
+    def _chunks(self):
+        if not self._source.seekable():
+            yield from iter(self._source.readline, "")
+            return
+        pending = []
+        while chunk := self._source.read(self.CHUNK_SIZE):
+            if not (cut := max(chunk.rfind("\n"), chunk.rfind("\r")) + 1):
+                pending.append(chunk)
+                continue
+            pending.append(chunk[:cut])
+            yield "".join(pending)
+            pending = [chunk[cut:]]
+        if rest := "".join(pending): yield rest
+
+    def _scan_into(self, tokens, base):
+        while (token := self.next_token()) != "$EOF":
+            tokens.append(base + self._token_start, self._current_position - self._token_start, token)
 
     def next_token(self):
         while True:
@@ -12,7 +105,7 @@ class Scanner:
                         self._current_position += 1
                 case _: break
 
-        start = self._current_position
+        start = self._token_start = self._current_position
         match self._current_char():
             case "$EOF": return "$EOF"
             case c if c.isalpha():
@@ -44,75 +137,476 @@ class Scanner:
         else:
             return "$EOF"
 
+import re
+import operator as op
+from bisect import bisect_right
+from itertools import accumulate, compress, islice, repeat
+
+class RegexScanner(Scanner):
+    # Splits the whole source with one pattern. The classes spell out what
+    # str.isspace, isalpha and isalnum accept in ASCII; other sources fall
+    # back to Scanner. scan() blanks out comments, splits the rest into
+    # separators and tokens and derives the columns without a per-token loop,
+    # except for names and numbers.
+
+    _TOKEN = re.compile(r"([A-Za-z]\w*)|([0-9]+)|(![^\r\n]*)|([<>]=?|[^\t-\r\x1c- ])", re.ASCII)
+    _COMMENT = re.compile(r"![^\r\n]*")
+    _SPLIT = re.compile(r"([A-Za-z]\w*|[0-9]+|[<>]=?|[^\t-\r\x1c- ])", re.ASCII)
+    _KEYWORDS = {"null": None, "true": True, "false": False}
+
+    def __init__(self, source) -> None:
+        super().__init__(source)
+        self._ascii = isinstance(source, str) and source.isascii()
+        self._tokens = None
+
+    def _scan_into(self, tokens, base):
+        if not self._ascii: return super()._scan_into(tokens, base)
+        source = self._COMMENT.sub(lambda comment: " " * len(comment[0]), self._source) if "!" in self._source else self._source
+        parts = self._SPLIT.split(source)
+        texts = parts[1::2]
+        lengths = array("i", map(len, texts))
+        ends = accumulate(map(op.add, map(len, parts[0:-1:2]), lengths), initial=base)
+        kinds = array("i", map(Token.KINDS.get, texts, repeat(Token.NAME)))
+        first, literals = len(tokens), tokens.literals
+        for index in compress(range(len(texts)), map(op.eq, kinds, repeat(Token.NAME))):
+            text = texts[index]
+            if text[0].isdigit():
+                kinds[index] = Token.NUMBER
+                literals[first + index] = int(text)
+            else: literals[first + index] = text
+        tokens.kinds.extend(kinds)
+        tokens.starts.extend(map(op.sub, islice(ends, 1, None), lengths))
+        tokens.lengths.extend(lengths)
+
+    def next_token(self):
+        if not self._ascii: return super().next_token()
+        if self._tokens is None: self._tokens = iter(self._tokenize(self._source))
+        return next(self._tokens, "$EOF")
+
+    def _tokenize(self, source):
+        keywords = self._KEYWORDS
+        return [keywords.get(name, name) if name else int(number) if number else other
+                for name, number, comment, other in self._TOKEN.findall(source) if not comment]
+
+class SourceMap:
+    # Where statements start in one source. marks maps id(statement) to the
+    # statement and its offset; Parser marks every statement it builds and
+    # the passes after it move the mark over to the nodes they build. Marks
+    # kept for statements in function bodies stay, since the function may
+    # run later; forget() drops the others once a top-level statement is
+    # done with. Line starts are only looked for when an error needs a
+    # position, so a program that runs cleanly never pays for them.
+
+    _NEWLINE = re.compile("\n")
+
+    def __init__(self, text, filename="<input>"):
+        self.text = text
+        self.filename = filename
+        self.marks = {}
+        self._kept = set()
+        self._transient = []
+        self._line_starts = None
+
+    def carry(self, node, new_node, keep=None):
+        if (entry := self.marks.pop(id(node), None)) is None: return new_node
+        if keep is None: keep = id(node) in self._kept
+        self._kept.discard(id(node))
+        if id(new_node) not in self.marks:
+            self.marks[id(new_node)] = entry = (new_node, entry[1])
+            if keep: self._kept.add(id(new_node))
+            else: self._transient.append(entry)
+        return new_node
+
+    def forget(self):
+        for entry in self._transient:
+            if self.marks.get(id(entry[0])) is entry: del self.marks[id(entry[0])]
+        self._transient = []
+
+    def record(self, text):
+        # Sources that cannot be read again give their lines as they are scanned.
+        if self._line_starts is None: self._line_starts, self._end = array("i", [0]), 0
+        self._line_starts.extend(self._end + match.end() for match in self._NEWLINE.finditer(text))
+        self._end += len(text)
+
+    def take(self, node):
+        # Drops node's mark and gives its offset.
+        self._kept.discard(id(node))
+        entry = self.marks.pop(id(node), None)
+        return None if entry is None else entry[1]
+
+    def offset(self, node, default=None):
+        entry = self.marks.get(id(node))
+        return default if entry is None else entry[1]
+
+    def position(self, offset):
+        if self._line_starts is None: self._line_starts = self._find_line_starts()
+        if not self._line_starts: return None
+        line = bisect_right(self._line_starts, offset)
+        return line, offset - self._line_starts[line - 1] + 1
+
+    def locate(self, error, offset):
+        if offset is not None and getattr(error, "location", None) is None:
+            if (position := self.position(offset)) is not None:
+                error.location = f"{self.filename}:{position[0]}:{position[1]}"
+        return error
+
+    def _find_line_starts(self):
+        # A text file is read again from the start; one that cannot seek
+        # has no positions.
+        if isinstance(self.text, str): chunks = [self.text]
+        elif self.text.seekable():
+            self.text.seek(0)
+            chunks = iter(lambda: self.text.read(Scanner.CHUNK_SIZE), "")
+        else: return array("i")
+        line_starts, end = array("i", [0]), 0
+        for chunk in chunks:
+            line_starts.extend(end + match.end() for match in self._NEWLINE.finditer(chunk))
+            end += len(chunk)
+        return line_starts
+
+    def locate_node(self, error, node): return self.locate(error, self.offset(node))
+
+from dataclasses import dataclass
+
+class Node:
+    # Typed AST nodes, an alternative to the list form that Parser builds.
+    # Each node keeps its fields in __slots__ and matches by class, as in
+    # `case Var(name, value)`. Names, numbers, true, false and null stay
+    # plain values, and sequences are tuples.
+    __slots__ = ()
+
+@dataclass(slots=True)
+class Program(Node): statements: tuple
+@dataclass(slots=True)
+class Block(Node): statements: tuple
+@dataclass(slots=True)
+class Var(Node): name: str; value: object
+@dataclass(slots=True)
+class Set(Node): name: str; value: object
+@dataclass(slots=True)
+class If(Node): cond: object; conseq: Block; alt: "Block | If"
+@dataclass(slots=True)
+class While(Node): cond: object; body: Block; then: Block
+@dataclass(slots=True)
+class For(Node): init_name: str; init_exp: object; cond: object; update_name: str; update_exp: object; body: Block
+@dataclass(slots=True)
+class Break(Node): pass
+@dataclass(slots=True)
+class Continue(Node): pass
+@dataclass(slots=True)
+class Return(Node): value: object
+@dataclass(slots=True)
+class Print(Node): expr: object
+@dataclass(slots=True)
+class Expr(Node): expr: object
+@dataclass(slots=True)
+class Func(Node): params: tuple; body: Block
+@dataclass(slots=True)
+class Neg(Node): operand: object
+@dataclass(slots=True)
+class Binary(Node): operator: str; left: object; right: object
+@dataclass(slots=True)
+class Ternary(Node): cond: object; conseq: object; alt: object
+@dataclass(slots=True)
+class Call(Node): func: object; args: tuple
+
+class NodeConverter:
+    # Converts a program or statement between the list form and nodes.
+    # Statement marks in the given SourceMap move to the converted statements.
+
+    def __init__(self, source=None):
+        self._marks = {} if source is None else source.marks
+
+    def to_nodes(self, tree):
+        match tree:
+            case ["program", *statements]: return Program(tuple(map(self._statement_node, statements)))
+            case _: return self._statement_node(tree)
+
+    def to_lists(self, tree):
+        match tree:
+            case Program(statements): return ["program", *map(self._statement_list, statements)]
+            case _: return self._statement_list(tree)
+
+    def _move_mark(self, old, new):
+        if (entry := self._marks.pop(id(old), None)) is not None: self._marks[id(new)] = new, entry[1]
+        return new
+
+    def _statement_node(self, statement):
+        match statement:
+            case ["block", *statements]: node = Block(tuple(map(self._statement_node, statements)))
+            case ["var", name, value]: node = Var(name, self._expr_node(value))
+            case ["set", name, value]: node = Set(name, self._expr_node(value))
+            case ["if", cond, conseq, alt]:
+                node = If(self._expr_node(cond), self._statement_node(conseq), self._statement_node(alt))
+            case ["while", cond, body, then]:
+                node = While(self._expr_node(cond), self._statement_node(body), self._statement_node(then))
+            case ["for", init_name, init_exp, cond, update_name, update_exp, body]:
+                node = For(init_name, self._expr_node(init_exp), self._expr_node(cond),
+                           update_name, self._expr_node(update_exp), self._statement_node(body))
+            case ["break"]: node = Break()
+            case ["continue"]: node = Continue()
+            case ["return", value]: node = Return(self._expr_node(value))
+            case ["print", expr]: node = Print(self._expr_node(expr))
+            case ["expr", expr]: node = Expr(self._expr_node(expr))
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+        return self._move_mark(statement, node)
+
+    def _expr_node(self, expr):
+        match expr:
+            case None | int() | str(): return expr
+            case ["func", params, body]: return Func(tuple(params), self._statement_node(body))
+            case ["-", a]: return Neg(self._expr_node(a))
+            case ["?", cond, conseq, alt]: return Ternary(self._expr_node(cond), self._expr_node(conseq), self._expr_node(alt))
+            case [("^" | "*" | "/" | "+" | "-" | "<" | "<=" | ">" | ">=" | "=" | "#" | "&" | "|") as operator, a, b]:
+                return Binary(operator, self._expr_node(a), self._expr_node(b))
+            case [func, *args]: return Call(self._expr_node(func), tuple(map(self._expr_node, args)))
+            case unexpected: assert False, f"Unexpected expression at `{unexpected}`."
+
+    def _statement_list(self, node):
+        match node:
+            case Block(statements): statement = ["block", *map(self._statement_list, statements)]
+            case Var(name, value): statement = ["var", name, self._expr_list(value)]
+            case Set(name, value): statement = ["set", name, self._expr_list(value)]
+            case If(cond, conseq, alt):
+                statement = ["if", self._expr_list(cond), self._statement_list(conseq), self._statement_list(alt)]
+            case While(cond, body, then):
+                statement = ["while", self._expr_list(cond), self._statement_list(body), self._statement_list(then)]
+            case For(init_name, init_exp, cond, update_name, update_exp, body):
+                statement = ["for", init_name, self._expr_list(init_exp), self._expr_list(cond),
+                             update_name, self._expr_list(update_exp), self._statement_list(body)]
+            case Break(): statement = ["break"]
+            case Continue(): statement = ["continue"]
+            case Return(value): statement = ["return", self._expr_list(value)]
+            case Print(expr): statement = ["print", self._expr_list(expr)]
+            case Expr(expr): statement = ["expr", self._expr_list(expr)]
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+        return self._move_mark(node, statement)
+
+    def _expr_list(self, expr):
+        match expr:
+            case None | int() | str(): return expr
+            case Func(params, body): return ["func", list(params), self._statement_list(body)]
+            case Neg(a): return ["-", self._expr_list(a)]
+            case Ternary(cond, conseq, alt): return ["?", self._expr_list(cond), self._expr_list(conseq), self._expr_list(alt)]
+            case Binary(operator, a, b): return [operator, self._expr_list(a), self._expr_list(b)]
+            case Call(func, args): return [self._expr_list(func), *map(self._expr_list, args)]
+            case unexpected: assert False, f"Unexpected expression at `{unexpected}`."
+
+class Arena:
+    # A tree in four array("q") columns, so its nodes are not Python objects
+    # for the GC to track. Node i has kind kinds[i]; first_children[i] is its
+    # first child and next_siblings[i] the next child of its parent, -1 if
+    # none. A call is a CALL node whose children are the callee and the
+    # arguments. Leaves are INT nodes, with the value in operands, or VALUE
+    # nodes, with an index into constants, where names, big integers and
+    # everything else are interned. Nodes are added children first, so a
+    # tree's root is the last node added. Either list form, as Parser builds
+    # it or as Resolver rewrites it, converts both ways; offsets keeps where
+    # each statement starts.
+
+    TAGS = ("program", "block", "seq", "var", "set", "if", "while", "for", "break", "continue", "return", "tailcall",
+            "print", "expr", "func", "$get", "-", "?", "^", "*", "/", "+", "<", "<=", ">", ">=", "=", "#", "&", "|",
+            "$call", "$int", "$value")
+    (PROGRAM, BLOCK, SEQ, VAR, SET, IF, WHILE, FOR, BREAK, CONTINUE, RETURN, TAILCALL,
+     PRINT, EXPR, FUNC, GET, MINUS, QUESTION, CARET, STAR, SLASH, PLUS, LT, LE, GT, GE, EQ, NE, AND, OR,
+     CALL, INT, VALUE) = range(len(TAGS))
+    KINDS = dict(zip(TAGS, range(CALL)))
+    # Tags that head a list in an expression; any other list there is a call.
+    OPERATORS = dict(zip(TAGS[FUNC:CALL], range(FUNC, CALL)))
+
+    def __init__(self, source=None):
+        self.source = source
+        self.kinds, self.first_children, self.next_siblings, self.operands = (array("q") for _ in range(4))
+        self.constants = []
+        self.offsets = {}
+        self._interned = {}
+
+    def __len__(self): return len(self.kinds)
+
+    def children(self, index):
+        child, next_siblings = self.first_children[index], self.next_siblings
+        while child >= 0:
+            yield child
+            child = next_siblings[child]
+
+    def value(self, index):
+        if self.kinds[index] == Arena.INT: return self.operands[index]
+        return self.constants[self.operands[index]]
+
+    def same(self, index, other, other_index):
+        # Whether two subtrees, maybe in different Arenas, are equal as lists.
+        kind = self.kinds[index]
+        if kind != other.kinds[other_index]: return False
+        if kind in (Arena.INT, Arena.VALUE): return self.value(index) == other.value(other_index)
+        children, other_children = list(self.children(index)), list(other.children(other_index))
+        return len(children) == len(other_children) and all(map(self.same, children, repeat(other), other_children))
+
+    def add(self, tree, statement=False):
+        if type(tree) is list and (statement or type(tree[0]) is str and tree[0] in self.OPERATORS):
+            kind, count = self.KINDS[tree[0]], len(tree) - 1
+            index = self._append(kind, [self._add_child(kind, position, count, child)
+                                        for position, child in enumerate(islice(tree, 1, None))])
+            if statement and self.source is not None and (offset := self.source.take(tree)) is not None:
+                self.offsets[index] = offset
+            return index
+        if type(tree) is list: return self._append(Arena.CALL, [self.add(child) for child in tree])
+        if type(tree) is int and -1 << 63 <= tree < 1 << 63: return self._append(Arena.INT, (), tree)
+        return self._append(Arena.VALUE, (), self._intern(tree))
+
+    def add_program(self, statements):
+        return self._append(Arena.PROGRAM, [self.add(statement, True) for statement in statements])
+
+    def to_lists(self, index=None, source=None):
+        # Statements are marked in source, by default the Arena's own; an
+        # Arena shared between runs is given the SourceMap of each run.
+        if index is None: index = len(self.kinds) - 1
+        if source is None: source = self.source
+        match self.kinds[index]:
+            case Arena.INT | Arena.VALUE: return self.value(index)
+            case Arena.CALL: return [self.to_lists(child, source) for child in self.children(index)]
+            case Arena.FUNC:
+                params, *rest = self.children(index)
+                tree = ["func", list(self.value(params)), *(self.to_lists(child, source) for child in rest)]
+            case kind: tree = [self.TAGS[kind], *(self.to_lists(child, source) for child in self.children(index))]
+        if source is not None and (offset := self.offsets.get(index)) is not None:
+            source.marks[id(tree)] = tree, offset
+        return tree
+
+    def _add_child(self, kind, position, count, child):
+        # Which children of a tagged list are statements, and so always tagged.
+        if kind == Arena.FUNC and position == 0: return self._append(Arena.VALUE, (), self._intern(tuple(child)))
+        match kind:
+            case Arena.PROGRAM | Arena.BLOCK | Arena.SEQ: statement = True
+            case Arena.IF | Arena.WHILE: statement = position > 0
+            case Arena.FOR: statement = position == 5 if count == 6 else position != 1
+            case Arena.FUNC: statement = position == 1
+            case _: statement = False
+        return self.add(child, statement)
+
+    def _append(self, kind, children, operand=0):
+        index = len(self.kinds)
+        self.kinds.append(kind)
+        self.first_children.append(children[0] if children else -1)
+        self.next_siblings.append(-1)
+        self.operands.append(operand)
+        for child, sibling in zip(children, islice(children, 1, None)): self.next_siblings[child] = sibling
+        return index
+
+    def _intern(self, value):
+        key = type(value), value
+        if (index := self._interned.get(key)) is None:
+            index = self._interned[key] = len(self.constants)
+            self.constants.append(value)
+        return index
+
 class Parser:
-    def __init__(self, source):
-        self.scanner = Scanner(source)
-        self._current_token = ""
-        self._next_token()
+    # With nodes=True, statements come out as Node trees instead of lists.
+    # With arena=True, parse_program() flattens each statement into an Arena
+    # as soon as it is parsed and gives the Arena.
+
+    def __init__(self, source, scanner=RegexScanner, filename="<input>", nodes=False, arena=False):
+        self.scanner = scanner(source)
+        self.source = SourceMap(source, filename)
+        self._marks = self.source.marks
+        self._converter = NodeConverter(self.source) if nodes else None
+        self._arena = arena
+        self._record = not isinstance(source, str) and not source.seekable()
+        self._chunks = self.scanner.scan_chunks()
+        self._blocks = 0
+        self._deferred = False
+        self._next_chunk()
+        self._kind = self._kinds[0]
+
+    @property
+    def _current_token(self): return self._tokens.value(self._index)
 
     def parse_program(self):
-        program: list = ["program"]
-        while self._current_token != "$EOF":
-            program.append(self._parse_statement())
-        return program
+        if self._arena:
+            arena = Arena(self.source)
+            arena.add_program(self._parse_statements())
+            return arena
+        if self._converter is None: return ["program", *self._parse_statements()]
+        return Program(tuple(self.parse_statements()))
+
+    def parse_statements(self):
+        if self._converter is None: return self._parse_statements()
+        return map(self._converter.to_nodes, self._parse_statements())
+
+    def _parse_statements(self):
+        # Yields top-level statements as they are parsed. One that ends with
+        # `;` at the end of a chunk is yielded before the next chunk is read,
+        # so a statement arriving on a pipe runs without waiting for more.
+        try:
+            while True:
+                if self._deferred:
+                    self._deferred = False
+                    self._next_token()
+                if self._kind == Token.EOF: return
+                yield self._parse_statement()
+        except AssertionError as e: raise self.source.locate(e, self._starts[self._index])
 
     def _parse_statement(self):
-        match self._current_token:
-            case "{": return self._parse_block()
-            case "var" | "set": return self._parse_var_set()
-            case "if": return self._parse_if()
-            case "while": return self._parse_while()
-            case "for": return self._parse_for()
-            case "break": return self._parse_break()
-            case "continue": return self._parse_continue()
-            case "def": return self._parse_def()
-            case "return": return self._parse_return()
-            case "print": return self._parse_print()
-            case _: return self._parse_expression_statement()
+        start = self._starts[self._index]
+        match self._kind:
+            case Token.LBRACE: statement = self._parse_block()
+            case Token.VAR | Token.SET: statement = self._parse_var_set()
+            case Token.IF: statement = self._parse_if()
+            case Token.WHILE: statement = self._parse_while()
+            case Token.FOR: statement = self._parse_for()
+            case Token.BREAK: statement = self._parse_break()
+            case Token.CONTINUE: statement = self._parse_continue()
+            case Token.DEF: statement = self._parse_def()
+            case Token.RETURN: statement = self._parse_return()
+            case Token.PRINT: statement = self._parse_print()
+            case _: statement = self._parse_expression_statement()
+        self._marks[id(statement)] = statement, start
+        return statement
 
     def _parse_block(self):
         block: list = ["block"]
+        self._blocks += 1
         self._next_token()
-        while self._current_token != "}":
+        while self._kind != Token.RBRACE:
             block.append(self._parse_statement())
+        self._blocks -= 1
         self._next_token()
         return block
 
     def _parse_var_set(self):
-        op = self._current_token
+        op = Token.TEXTS[self._kind]
         self._next_token()
         name = self._parse_primary()
         assert isinstance(name, str),  f"Expected a name, found `{name}`."
         value = None
-        if op == "set" or self._current_token != ";":
-            self._consume_token("=")
+        if op == "set" or self._kind != Token.SEMICOLON:
+            self._consume_token(Token.EQ)
             value = self._parse_expression()
-        self._consume_token(";")
+        self._end_statement()
         return [op, name, value]
 
     def _parse_if(self):
         self._next_token()
         cond = self._parse_expression()
-        self._check_token("{")
+        self._check_token(Token.LBRACE)
         conseq = self._parse_block()
         alt = ["block"]
-        if self._current_token == "elif":
+        if self._kind == Token.ELIF:
             alt = self._parse_if()
-        elif self._current_token == "else":
+        elif self._kind == Token.ELSE:
             self._next_token()
-            self._check_token("{")
+            self._check_token(Token.LBRACE)
             alt = self._parse_block()
         return ["if", cond, conseq, alt]
 
     def _parse_while(self):
         self._next_token()
         cond = self._parse_expression()
-        self._check_token("{")
+        self._check_token(Token.LBRACE)
         body = self._parse_block()
         then = ["block"]
-        if self._current_token == "then":
+        if self._kind == Token.THEN:
             self._next_token()
-            self._check_token("{")
+            self._check_token(Token.LBRACE)
             then = self._parse_block()
         return ["while", cond, body, then]
 
@@ -120,27 +614,27 @@ class Parser:
         self._next_token()
         init_name = self._parse_primary()
         assert isinstance(init_name, str),  f"Expected a name, found `{init_name}`."
-        self._consume_token("=")
+        self._consume_token(Token.EQ)
         init_exp = self._parse_expression()
-        self._consume_token(";")
+        self._consume_token(Token.SEMICOLON)
         cond = self._parse_expression()
-        self._consume_token(";")
+        self._consume_token(Token.SEMICOLON)
         update_name = self._parse_primary()
         assert isinstance(update_name, str),  f"Expected a name, found `{update_name}`."
-        self._consume_token("=")
+        self._consume_token(Token.EQ)
         update_exp = self._parse_expression()
-        self._check_token("{")
+        self._check_token(Token.LBRACE)
         body = self._parse_block()
         return ["for", init_name, init_exp, cond, update_name, update_exp, body]
 
     def _parse_break(self):
         self._next_token()
-        self._consume_token(";")
+        self._end_statement()
         return ["break"]
 
     def _parse_continue(self):
         self._next_token()
-        self._consume_token(";")
+        self._end_statement()
         return ["continue"]
 
     def _parse_def(self):
@@ -154,86 +648,75 @@ class Parser:
     def _parse_return(self):
         self._next_token()
         value = None
-        if self._current_token != ";": value = self._parse_expression()
-        self._consume_token(";")
+        if self._kind != Token.SEMICOLON: value = self._parse_expression()
+        self._end_statement()
         return ["return", value]
 
     def _parse_print(self):
         self._next_token()
         expr = self._parse_expression()
-        self._consume_token(";")
+        self._end_statement()
         return ["print", expr]
 
     def _parse_expression_statement(self):
         expr = self._parse_expression()
-        self._consume_token(";")
+        self._end_statement()
         return ["expr", expr]
 
-    def _parse_expression(self): return self._perse_ternary()
-
-    def _perse_ternary(self):
-        cond = self._parse_or()
-        if self._current_token != "?": return cond
-        self._next_token()
-        conseq = self._perse_ternary()
-        self._consume_token(":")
-        alt = self._perse_ternary()
-        return ["?", cond, conseq, alt]
-
-    def _parse_or(self): return self._parse_binop_left(("|",), self._parse_and)
-    def _parse_and(self): return self._parse_binop_left(("&",), self._parse_equality)
-    def _parse_equality(self): return self._parse_binop_left(("=", "#"), self._parse_comparison)
-    def _parse_comparison(self): return self._parse_binop_left((">", ">=", "<", "<="), self._parse_add_sub)
-    def _parse_add_sub(self): return self._parse_binop_left(("+", "-"), self._parse_mult_div)
-    def _parse_mult_div(self): return self._parse_binop_left(("*", "/"), self._parse_power)
-
-    def _parse_binop_left(self, ops, sub_element):
-        result = sub_element()
-        while (op := self._current_token) in ops:
+    # Binding power of each kind as an infix operator, 0 for the rest. An
+    # operator takes operands that bind tighter than itself on the right,
+    # except `^`, which is right associative, and `?`, whose branches are
+    # whole expressions.
+    _POWERS = tuple(map({Token.QUESTION: 1, Token.OR: 2, Token.AND: 3, Token.EQ: 4, Token.NE: 4,
+                         Token.GT: 5, Token.GE: 5, Token.LT: 5, Token.LE: 5, Token.PLUS: 6, Token.MINUS: 6,
+                         Token.STAR: 7, Token.SLASH: 7, Token.CARET: 8}.get, range(len(Token.TEXTS)), repeat(0)))
+
+    def _parse_expression(self, power=0):
+        left, powers = self._parse_unary(), self._POWERS
+        while powers[kind := self._kind] > power:
             self._next_token()
-            result = [op, result, sub_element()]
-        return result
-
-    def _parse_power(self):
-        power = self._parse_unary()
-        if self._current_token != "^": return power
-        self._next_token()
-        return ["^", power, self._parse_power()]
+            if kind == Token.QUESTION:
+                conseq = self._parse_expression()
+                self._consume_token(Token.COLON)
+                left = ["?", left, conseq, self._parse_expression()]
+            elif kind == Token.CARET: left = ["^", left, self._parse_expression(powers[kind] - 1)]
+            else: left = [Token.TEXTS[kind], left, self._parse_expression(powers[kind])]
+        return left
 
     def _parse_unary(self):
-        if self._current_token == "-":
+        if self._kind == Token.MINUS:
             self._next_token()
             return ["-", self._parse_unary()]
         return self._parse_call()
 
     def _parse_call(self):
         call = self._parse_primary()
-        while self._current_token == "(":
+        while self._kind == Token.LPAREN:
             self._next_token()
             args = []
-            while self._current_token != ")":
+            while self._kind != Token.RPAREN:
                 args.append(self._parse_expression())
-                if self._current_token != ")":
-                    self._consume_token(",")
+                if self._kind != Token.RPAREN:
+                    self._consume_token(Token.COMMA)
             call = [call] + args
-            self._consume_token(")")
+            self._consume_token(Token.RPAREN)
         return call
 
     def _parse_primary(self):
-        match self._current_token:
-            case "(":
+        match self._kind:
+            case Token.LPAREN:
                 self._next_token()
                 exp = self._parse_expression()
-                self._consume_token(")")
+                self._consume_token(Token.RPAREN)
                 return exp
-            case "func": return self._parse_func()
-            case None:
-                self._next_token()
-                return None
-            case int(value) | str(value) | bool(value):
+            case Token.FUNC: return self._parse_func()
+            case Token.NAME | Token.NUMBER:
+                value = self._tokens.literals[self._index]
                 self._next_token()
                 return value
-            case unexpected: assert False, f"Unexpected token `{unexpected}`."
+            case kind:
+                self._next_token()
+                return Token.VALUES[kind]
 
     def _parse_func(self):
         self._next_token()
@@ -242,176 +725,1140 @@ class Parser:
         return ["func", params, body]
 
     def _parse_parameters(self):
-        self._consume_token("(")
+        self._consume_token(Token.LPAREN)
         params = []
-        while self._current_token != ")":
-            param = self._current_token
-            assert isinstance(param, str), f"Name expected, found `{param}`."
+        while self._kind != Token.RPAREN:
+            assert self._kind >= Token.NAME, f"Name expected, found `{self._current_token}`."
+            params.append(self._current_token)
             self._next_token()
-            params.append(param)
-            if self._current_token != ")":
-                self._consume_token(",")
-        self._consume_token(")")
+            if self._kind != Token.RPAREN:
+                self._consume_token(Token.COMMA)
+        self._consume_token(Token.RPAREN)
         return params
 
-    def _check_token(self, expected_token):
-        assert self._current_token == expected_token, \
-               f"Expected `{expected_token}`, found `{self._current_token}`."
+    def _check_token(self, expected_kind):
+        assert self._kind == expected_kind, \
+               f"Expected `{Token.TEXTS[expected_kind]}`, found `{self._current_token}`."
 
-    def _consume_token(self, expected_token):
-        self._check_token(expected_token)
+    def _consume_token(self, expected_kind):
+        self._check_token(expected_kind)
         return self._next_token()
 
+    def _end_statement(self):
+        self._check_token(Token.SEMICOLON)
+        if self._index == self._last and not self._blocks: self._deferred = True
+        else: self._next_token()
+
     def _next_token(self):
-        self._current_token = self.scanner.next_token()
-        return self._current_token
+        if self._index < self._last: self._index += 1
+        elif self._chunks is not None: self._next_chunk()
+        self._kind = self._kinds[self._index]
+        return self._kind
+
+    def _next_chunk(self):
+        while True:
+            tokens = next(self._chunks)
+            if self._record: self.source.record(tokens.source)
+            if tokens: break
+        self._tokens, self._kinds, self._starts = tokens, tokens.kinds, tokens.starts
+        self._index, self._last = 0, len(tokens) - 1
+        if self._kinds[self._last] == Token.EOF: self._chunks = None
+
+class IterativeParser(Parser):
+    # Parses like Parser without recursing in Python. Each _iter_ method is
+    # a generator that yields the generator of a nested construct and gets
+    # its result back; _run() keeps the pending ones on a list, so nesting
+    # is bounded by max_depth rather than by the Python stack. elif chains
+    # and runs of unary minus are parsed in a loop.
+
+    def __init__(self, source, scanner=RegexScanner, filename="<input>", max_depth=100000, nodes=False, arena=False):
+        super().__init__(source, scanner, filename, nodes, arena)
+        self._max_depth = max_depth
+
+    def parse_program(self):
+        # Building nodes or an Arena still recurses.
+        try: return super().parse_program()
+        except RecursionError: pass
+        assert False, f"Nesting too deep."
+
+    def _parse_statement(self): return self._run(self._iter_statement())
+
+    def _run(self, parse):
+        stack, value = [parse], None
+        while True:
+            try: parse = stack[-1].send(value)
+            except StopIteration as stop:
+                stack.pop()
+                if not stack: return stop.value
+                value = stop.value
+                continue
+            assert len(stack) < self._max_depth, f"Nesting deeper than {self._max_depth}."
+            stack.append(parse)
+            value = None
+
+    def _iter_statement(self):
+        start = self._starts[self._index]
+        match self._kind:
+            case Token.LBRACE: statement = yield self._iter_block()
+            case Token.VAR | Token.SET: statement = yield self._iter_var_set()
+            case Token.IF: statement = yield self._iter_if()
+            case Token.WHILE: statement = yield self._iter_while()
+            case Token.FOR: statement = yield self._iter_for()
+            case Token.BREAK: statement = self._parse_break()
+            case Token.CONTINUE: statement = self._parse_continue()
+            case Token.DEF: statement = yield self._iter_def()
+            case Token.RETURN: statement = yield self._iter_return()
+            case Token.PRINT: statement = yield self._iter_print()
+            case _: statement = yield self._iter_expression_statement()
+        self._marks[id(statement)] = statement, start
+        return statement
+
+    def _iter_block(self):
+        block: list = ["block"]
+        self._blocks += 1
+        self._next_token()
+        while self._kind != Token.RBRACE:
+            block.append((yield self._iter_statement()))
+        self._blocks -= 1
+        self._next_token()
+        return block
+
+    def _iter_var_set(self):
+        op = Token.TEXTS[self._kind]
+        self._next_token()
+        name = yield self._iter_primary()
+        assert isinstance(name, str),  f"Expected a name, found `{name}`."
+        value = None
+        if op == "set" or self._kind != Token.SEMICOLON:
+            self._consume_token(Token.EQ)
+            value = yield self._iter_expression()
+        self._end_statement()
+        return [op, name, value]
+
+    def _iter_if(self):
+        branches = []
+        while True:
+            self._next_token()
+            cond = yield self._iter_expression()
+            self._check_token(Token.LBRACE)
+            branches.append((cond, (yield self._iter_block())))
+            if self._kind != Token.ELIF: break
+        alt = ["block"]
+        if self._kind == Token.ELSE:
+            self._next_token()
+            self._check_token(Token.LBRACE)
+            alt = yield self._iter_block()
+        for cond, conseq in reversed(branches): alt = ["if", cond, conseq, alt]
+        return alt
+
+    def _iter_while(self):
+        self._next_token()
+        cond = yield self._iter_expression()
+        self._check_token(Token.LBRACE)
+        body = yield self._iter_block()
+        then = ["block"]
+        if self._kind == Token.THEN:
+            self._next_token()
+            self._check_token(Token.LBRACE)
+            then = yield self._iter_block()
+        return ["while", cond, body, then]
+
+    def _iter_for(self):
+        self._next_token()
+        init_name = yield self._iter_primary()
+        assert isinstance(init_name, str),  f"Expected a name, found `{init_name}`."
+        self._consume_token(Token.EQ)
+        init_exp = yield self._iter_expression()
+        self._consume_token(Token.SEMICOLON)
+        cond = yield self._iter_expression()
+        self._consume_token(Token.SEMICOLON)
+        update_name = yield self._iter_primary()
+        assert isinstance(update_name, str),  f"Expected a name, found `{update_name}`."
+        self._consume_token(Token.EQ)
+        update_exp = yield self._iter_expression()
+        self._check_token(Token.LBRACE)
+        body = yield self._iter_block()
+        return ["for", init_name, init_exp, cond, update_name, update_exp, body]
+
+    def _iter_def(self):
+        self._next_token()
+        name = yield self._iter_primary()
+        assert isinstance(name, str),  f"Expected a name, found `{name}`."
+        params = self._parse_parameters()
+        body = yield self._iter_block()
+        return ["var", name, ["func", params, body]]
+
+    def _iter_return(self):
+        self._next_token()
+        value = None
+        if self._kind != Token.SEMICOLON: value = yield self._iter_expression()
+        self._end_statement()
+        return ["return", value]
+
+    def _iter_print(self):
+        self._next_token()
+        expr = yield self._iter_expression()
+        self._end_statement()
+        return ["print", expr]
+
+    def _iter_expression_statement(self):
+        expr = yield self._iter_expression()
+        self._end_statement()
+        return ["expr", expr]
+
+    def _iter_expression(self, power=0):
+        left, powers = (yield self._iter_operand()), self._POWERS
+        while powers[kind := self._kind] > power:
+            self._next_token()
+            if kind == Token.QUESTION:
+                conseq = yield self._iter_expression()
+                self._consume_token(Token.COLON)
+                left = ["?", left, conseq, (yield self._iter_expression())]
+            elif kind == Token.CARET: left = ["^", left, (yield self._iter_expression(powers[kind] - 1))]
+            else: left = [Token.TEXTS[kind], left, (yield self._iter_expression(powers[kind]))]
+        return left
+
+    def _iter_operand(self):
+        minus = 0
+        while self._kind == Token.MINUS:
+            self._next_token()
+            minus += 1
+        if self._kind == Token.LPAREN or self._kind == Token.FUNC: call = yield self._iter_primary()
+        else: call = self._parse_primary()
+        while self._kind == Token.LPAREN:
+            self._next_token()
+            args = []
+            while self._kind != Token.RPAREN:
+                args.append((yield self._iter_expression()))
+                if self._kind != Token.RPAREN:
+                    self._consume_token(Token.COMMA)
+            call = [call] + args
+            self._consume_token(Token.RPAREN)
+        for _ in range(minus): call = ["-", call]
+        return call
+
+    def _iter_primary(self):
+        match self._kind:
+            case Token.LPAREN:
+                self._next_token()
+                exp = yield self._iter_expression()
+                self._consume_token(Token.RPAREN)
+                return exp
+            case Token.FUNC:
+                self._next_token()
+                params = self._parse_parameters()
+                body = yield self._iter_block()
+                return ["func", params, body]
+            case _: return self._parse_primary()
+
+import hashlib, marshal, os, sys, tempfile
+
+class AstCache:
+    # Keeps the parsed program of a source file in a sidecar .mlc file, the
+    # way Python keeps .pyc files, so a run that finds the source unchanged
+    # skips scanning and parsing. The header names the format, the
+    # interpreter and a hash of the source; a file with any other header is
+    # parsed again and overwritten. The program is marshalled as lists along
+    # with where its statements start, each found by its path from the
+    # statement around it. Writes go to a temporary file that is renamed
+    # into place, so runs at the same time see the old file or the new one.
+
+    FORMAT = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = os.path.splitext(filename)[0] + ".mlc"
+        self._header = None
+
+    def parse(self, file, make_parser=Parser):
+        # file is self.filename opened as text. Gives the program as lists
+        # and its SourceMap, as parsing it would.
+        source = SourceMap(file, self.filename)
+        if (program := self.load(source)) is None:
+            parser = make_parser(file, filename=self.filename, nodes=False, arena=False)
+            program, source = parser.parse_program(), parser.source
+            self.store(program, source)
+        return program, source
+
+    def header(self):
+        if self._header is None:
+            digest = hashlib.sha256()
+            with open(self.filename, "rb") as f:
+                while chunk := f.read(Scanner.CHUNK_SIZE): digest.update(chunk)
+            tag = f"mlc{self.FORMAT} {sys.implementation.cache_tag}\n".encode()
+            self._header = tag + digest.digest()
+        return self._header
+
+    def load(self, source):
+        header = self.header()
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(header)) != header: return None
+                program, marks = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError): return None
+        statements = []
+        for parent, path, offset in marks:
+            statement = program if parent < 0 else statements[parent]
+            for index in path: statement = statement[index]
+            statements.append(statement)
+            source.marks[id(statement)] = statement, offset
+        return program
+
+    def store(self, program, source):
+        marks, pending = [], [(program, -1, ())]
+        while pending:
+            node, parent, path = pending.pop()
+            if (offset := source.offset(node)) is not None:
+                marks.append((parent, path, offset))
+                parent, path = len(marks) - 1, ()
+            pending.extend((child, parent, (*path, index)) for index, child in enumerate(node) if type(child) is list)
+        # A program too deep to marshal, or a directory that cannot be
+        # written, goes without a cache; the run goes on either way.
+        try: data = self.header() + marshal.dumps((program, marks))
+        except (OSError, ValueError): return
+        directory, name = os.path.split(self.path)
+        try: file = tempfile.NamedTemporaryFile("wb", dir=directory or ".", prefix=name, delete=False)
+        except OSError: return
+        stored = False
+        try:
+            with file: file.write(data)
+            os.chmod(file.name, os.stat(self.filename).st_mode & 0o666)
+            os.replace(file.name, self.path)
+            stored = True
+        except OSError: pass
+        finally:
+            if not stored:
+                try: os.unlink(file.name)
+                except OSError: pass
+
+import threading
+from collections import OrderedDict
+
+class ParseCache:
+    # Parsed programs by source text and filename, for embedders and the
+    # REPL that parse the same sources over and over. At most size programs
+    # are kept and the least recently used one goes first. A hit gets a
+    # SourceMap of its own, since the passes after Parser take marks from
+    # it and an Arena turned into lists marks its statements there; the
+    # program itself is shared and must not be changed. A lock guards the
+    # entries, so threads may share a cache; parsing is done outside of it.
+    # A process keeps one for each make_parser it parses with.
+
+    def __init__(self, size=256, make_parser=Parser):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._make_parser = make_parser
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self): return len(self._entries)
+
+    def parse(self, text, filename="<input>"):
+        key = text, filename
+        with self._lock:
+            if (entry := self._entries.get(key)) is None: self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        if entry is None:
+            parser = self._make_parser(text, filename=filename)
+            entry = parser.parse_program(), dict(parser.source.marks)
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        program, marks = entry
+        source = SourceMap(text, filename)
+        source.marks.update(marks)
+        return program, source
+
+    def clear(self):
+        with self._lock: self._entries.clear()
+
+GLOBAL = -1
+
+class Scope:
+    def __init__(self, function, frame: "Scope | None"=None):
+        self.names = [] if frame is None else frame.names
+        self.slots = {}
+        self.declared = set()
+        self.function = function
+        self.has_frame = frame is None
+
+    def add(self, name):
+        self.slots[name] = len(self.names)
+        self.names.append(name)
+
+class CallNames(tuple):
+    # The names of a call frame that a function body shares: the first
+    # params of them are the parameters and the rest the body's, which
+    # print_env shows as scopes of their own, as if the body had a frame.
+
+    def __new__(cls, names, params):
+        self = super().__new__(cls, names)
+        self.params = params
+        return self
+
+class Resolver:
+    # Rewrites names into addresses. A reference becomes ["$get", depth, slot],
+    # `var` becomes ["var", slot, value], `set` becomes ["set", depth, slot, value],
+    # blocks carry their frame's names as ["block", names, *statements] and
+    # `for` becomes ["for", init, cond, update, body]. depth is GLOBAL for globals.
+    # A call returned from a function becomes ["tailcall", func, *args].
+    # Blocks that need no frame of their own become ["seq", *statements];
+    # functions become ["func", params, body, names, memo] and run their body in
+    # the call frame, whose names are then CallNames. Once a program mentions
+    # print_env, it and every later program keep one frame per block so that
+    # print_env shows every scope as before, even when called under another
+    # name; an evaluator passes frame_per_block on from one Resolver to the
+    # next. A function resolved earlier still shares its call frame, so an
+    # alias of print_env shows a declaration-free block within it as no scope.
+    # A Resolver may be given one program after another and keeps the global
+    # scope between them. With forward=True, a function may mention a global
+    # that a later program declares; check_forward_names() tells whether one
+    # never was. Programs may be given as lists or as Node trees. declared
+    # names the globals that may not be declared again, all of them by
+    # default; a global whose program failed before defining it may be.
+
+    def __init__(self, global_names, source=None, forward=False, declared=None, frame_per_block=False):
+        self._global_names = global_names
+        self._declared = declared
+        self.frame_per_block = frame_per_block
+        self._source = SourceMap("") if source is None else source
+        self._forward = set() if forward else None
+        self._scopes = []
+        self._function = 0
+
+    def resolve_program(self, program):
+        match program:
+            case ["program", *statements] | Program(statements):
+                self.begin_program(self._declared_names(statements), self.frame_per_block or self._mentions(statements, "print_env"))
+                resolved = ["program", *[self._resolve_statement(statement) for statement in statements]]
+                self.end_program()
+                return resolved
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+
+    # A program may also be resolved a top-level statement at a time:
+    # begin_program() with the globals it declares and whether it mentions
+    # print_env, resolve_statement() for each statement, then end_program().
+
+    def begin_program(self, names, mentions_print_env):
+        if mentions_print_env: self.frame_per_block = True
+        if not self._scopes:
+            scope = Scope(self._function)
+            for name in self._global_names: scope.add(name)
+            scope.declared.update(scope.names if self._declared is None else self._declared)
+            self._scopes = [scope]
+        scope = self._scopes[0]
+        for name in names:
+            if name not in scope.slots: scope.add(name)
+
+    def resolve_statement(self, statement): return self._resolve_statement(statement)
+
+    def end_program(self):
+        self._global_names += self._scopes[0].names[len(self._global_names):]
+
+    def check_forward_names(self):
+        if not self._forward: return
+        for name in sorted(self._forward - self._scopes[0].declared): assert False, f"`{name}` not defined."
+
+    def _hoist(self, scope, statements):
+        for name in self._declared_names(statements):
+            if name not in scope.slots: scope.add(name)
+
+    def _declared_names(self, statements):
+        for statement in statements:
+            match statement:
+                case ["var", name, _] | ["for", name, *_] | Var(name) | For(name): yield name
+
+    def _mentions(self, node, name):
+        match node:
+            case str(): return node == name
+            case list() | tuple(): return any(self._mentions(child, name) for child in node)
+            case Node(): return any(self._mentions(getattr(node, field), name) for field in node.__slots__)
+            case _: return False
+
+    def _resolve_statement(self, statement):
+        try: return self._source.carry(statement, self._rewrite_statement(statement), self._function > 0)
+        except AssertionError as e: raise self._source.locate_node(e, statement)
+
+    def _rewrite_statement(self, statement):
+        match statement:
+            case ["block", *statements] | Block(statements): return self._resolve_block(statements)
+            case ["var", name, value] | Var(name, value): return self._resolve_var(name, value)
+            case ["set", name, value] | Set(name, value):
+                value = self._resolve_expr(value)
+                return ["set", *self._lookup(name), value]
+            case ["if", cond, conseq, alt] | If(cond, conseq, alt):
+                return ["if", self._resolve_expr(cond), self._resolve_statement(conseq), self._resolve_statement(alt)]
+            case ["while", cond, body, then] | While(cond, body, then):
+                return ["while", self._resolve_expr(cond), self._resolve_statement(body), self._resolve_statement(then)]
+            case (["for", init_name, init_exp, cond, update_name, update_exp, body] |
+                  For(init_name, init_exp, cond, update_name, update_exp, body)):
+                init, cond = self._resolve_var(init_name, init_exp), self._resolve_expr(cond)
+                body = self._resolve_statement(body)
+                return ["for", init, cond, self._resolve_statement(["set", update_name, update_exp]), body]
+            case ["break"] | ["continue"]: return statement
+            case Break(): return ["break"]
+            case Continue(): return ["continue"]
+            case ["return", value] | Return(value): return self._resolve_return(value)
+            case ["print", expr] | Print(expr): return ["print", self._resolve_expr(expr)]
+            case ["expr", expr] | Expr(expr): return ["expr", self._resolve_expr(expr)]
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+
+    def _resolve_return(self, value):
+        match self._resolve_expr(value):
+            case [str(), *_] as value: return ["return", value]
+            case [func, *args] if self._function: return ["tailcall", func, *args]
+            case value: return ["return", value]
+
+    def _resolve_block(self, statements, frame=None):
+        if not statements: return ["seq"]
+        scope = Scope(self._function, frame)
+        self._hoist(scope, statements)
+        if not scope.slots and frame is None and not self.frame_per_block:
+            return ["seq", *[self._resolve_statement(statement) for statement in statements]]
+        self._scopes.append(scope)
+        resolved = [self._resolve_statement(statement) for statement in statements]
+        self._scopes.pop()
+        if not scope.has_frame: return ["seq", *resolved]
+        return ["block", tuple(scope.names), *resolved]
+
+    def _resolve_var(self, name, value):
+        value = self._resolve_expr(value)
+        scope = self._scopes[-1]
+        assert name not in scope.declared, f"`{name}` already defined."
+        scope.declared.add(name)
+        return ["var", scope.slots[name], value]
+
+    def _resolve_func(self, params, body):
+        enclosing_function = self._function
+        self._function += 1
+        scope = Scope(self._function)
+        for param in params:
+            assert param not in scope.slots, f"`{param}` already defined."
+            scope.add(param)
+        scope.declared.update(params)
+        self._scopes.append(scope)
+        match body:
+            case ["block", *statements] | Block(statements):
+                body = self._resolve_block(statements, None if self.frame_per_block else scope)
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+        self._scopes.pop()
+        self._function = enclosing_function
+        names = tuple(scope.names) if self.frame_per_block else CallNames(scope.names, len(params))
+        return ["func", list(params), body, names, None]
+
+    def _resolve_expr(self, expr):
+        match expr:
+            case None | int() | bool(): return expr
+            case str(name): return ["$get", *self._lookup(name)]
+            case ["func", params, body] | Func(params, body): return self._resolve_func(params, body)
+            case ["-", a] | Neg(a): return ["-", self._resolve_expr(a)]
+            case ([("^" | "*" | "/" | "+" | "-" | "<" | "<=" | ">" | ">=" | "=" | "#" | "&" | "|") as operator, a, b] |
+                  Binary(operator, a, b)):
+                return [operator, self._resolve_expr(a), self._resolve_expr(b)]
+            case ["?", cond, conseq, alt] | Ternary(cond, conseq, alt):
+                return ["?", self._resolve_expr(cond), self._resolve_expr(conseq), self._resolve_expr(alt)]
+            case [func, *args] | Call(func, args): return [self._resolve_expr(func), *[self._resolve_expr(arg) for arg in args]]
+            case unexpected: assert False, f"Unexpected expression at `{unexpected}`."
+
+    def _lookup(self, name):
+        # Code runs in order within a function, so only names declared so far
+        # are visible there; a function body may refer to any name its
+        # enclosing scopes declare, since it runs later.
+        depth = 0
+        for scope in reversed(self._scopes):
+            visible = scope.declared if scope.function == self._function else scope.slots
+            if name in visible:
+                if scope is self._scopes[0]: return GLOBAL, scope.slots[name]
+                return depth, scope.slots[name]
+            if scope.has_frame: depth += 1
+        assert self._forward is not None and self._function, f"`{name}` not defined."
+        self._forward.add(name)
+        self._scopes[0].add(name)
+        return GLOBAL, self._scopes[0].slots[name]
+
+class Optimizer:
+    # Works on resolved programs, so that names in pruned branches are still
+    # checked and frames keep their slots. Anything that could fail at run
+    # time, like `1 / 0` or `-null`, is left for the evaluator to report.
+    def __init__(self, source=None):
+        self._source = SourceMap("") if source is None else source
+
+    def optimize_program(self, program):
+        match program:
+            case ["program", *statements]: return ["program", *self._optimize_statements(statements)]
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+
+    def _optimize_statements(self, statements):
+        optimized = []
+        for original in statements:
+            if (statement := self._optimize_statement(original)) is None: continue
+            optimized.append(self._source.carry(original, statement))
+            if statement[0] in ("break", "continue", "return", "tailcall"): break
+        return optimized
+
+    def _optimize_statement(self, statement):
+        match statement:
+            case ["block", names, *statements]: return ["block", names, *self._optimize_statements(statements)]
+            case ["seq", *statements]: return ["seq", *self._optimize_statements(statements)]
+            case ["var", slot, value]: return ["var", slot, self._optimize_expr(value)]
+            case ["set", depth, slot, value]: return ["set", depth, slot, self._optimize_expr(value)]
+            case ["if", cond, conseq, alt]:
+                cond = self._optimize_expr(cond)
+                if self._is_constant(cond): return self._optimize_statement(conseq if cond else alt)
+                return ["if", cond, self._optimize_statement(conseq), self._optimize_statement(alt)]
+            case ["while", cond, body, then]:
+                cond = self._optimize_expr(cond)
+                if self._is_constant(cond) and not cond: return self._optimize_statement(then)
+                return ["while", cond, self._optimize_statement(body), self._optimize_statement(then)]
+            case ["for", init, cond, update, body]:
+                init, cond = self._optimize_statement(init), self._optimize_expr(cond)
+                if self._is_constant(cond) and not cond: return init
+                return ["for", init, cond, self._optimize_statement(update), self._optimize_statement(body)]
+            case ["break"] | ["continue"]: return statement
+            case ["return" | "print" as op, expr]: return [op, self._optimize_expr(expr)]
+            case ["tailcall", func, *args]: return ["tailcall", *[self._optimize_expr(expr) for expr in [func, *args]]]
+            case ["expr", expr]:
+                expr = self._optimize_expr(expr)
+                return None if self._is_constant(expr) else ["expr", expr]
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+
+    def _optimize_expr(self, expr):
+        match expr:
+            case None | int() | bool() | ["$get", _, _]: return expr
+            case ["func", params, body, names, memo]: return ["func", params, self._optimize_statement(body), names, memo]
+            case ["-", a]: return self._fold_unary_minus(self._optimize_expr(a))
+            case [("^" | "*" | "/" | "+" | "-" | "<" | "<=" | ">" | ">=") as operator, a, b]:
+                return self._fold_calc(operator, self._optimize_expr(a), self._optimize_expr(b))
+            case [("=" | "#") as operator, a, b]:
+                a, b = self._optimize_expr(a), self._optimize_expr(b)
+                if self._is_constant(a) and self._is_constant(b): return (a == b) == (operator == "=")
+                return [operator, a, b]
+            case ["&", a, b]:
+                a = self._optimize_expr(a)
+                if self._is_constant(a): return self._optimize_expr(b) if a else a
+                return ["&", a, self._optimize_expr(b)]
+            case ["|", a, b]:
+                a = self._optimize_expr(a)
+                if self._is_constant(a): return a if a else self._optimize_expr(b)
+                return ["|", a, self._optimize_expr(b)]
+            case ["?", cond, conseq, alt]:
+                cond = self._optimize_expr(cond)
+                if self._is_constant(cond): return self._optimize_expr(conseq if cond else alt)
+                return ["?", cond, self._optimize_expr(conseq), self._optimize_expr(alt)]
+            case [func, *args]: return [self._optimize_expr(func), *[self._optimize_expr(arg) for arg in args]]
+            case unexpected: assert False, f"Unexpected expression at `{unexpected}`."
+
+    def _fold_unary_minus(self, a):
+        match a:
+            case int(): return -a
+            case ["-", b] if self._is_int_valued(b): return b
+            case _: return ["-", a]
+
+    def _fold_calc(self, operator, a, b):
+        if isinstance(a, int) and isinstance(b, int) and self._is_safe(operator, a, b):
+            return self._calc(operator, a, b)
+        match operator, a, b:
+            case ("*" | "/" | "^", _, 1) | ("+" | "-", _, 0) if self._is_int_valued(a): return a
+            case ("*", 1, _) | ("+", 0, _) if self._is_int_valued(b): return b
+        return [operator, a, b]
+
+    def _is_safe(self, operator, a, b):
+        match operator:
+            case "/": return b != 0
+            case "^": return 0 <= b and abs(a).bit_length() * b <= 4096
+            case _: return True
+
+    def _calc(self, operator, a, b):
+        match operator:
+            case "^": return a ** b
+            case "*": return a * b
+            case "/": return a // b
+            case "+": return a + b
+            case "-": return a - b
+            case "<": return a < b
+            case "<=": return a <= b
+            case ">": return a > b
+            case ">=": return a >= b
+
+    def _is_constant(self, expr): return expr is None or isinstance(expr, int)
+
+    def _is_int_valued(self, expr):
+        match expr:
+            case bool(): return False
+            case int(): return True
+            case [("*" | "/" | "+" | "-"), _, _] | ["-", _]: return True
+            case _: return False
+
+UNDEFINED = object()
 
 class Environment:
-    def __init__(self, parent:"Environment | None"=None):
-        self._values = {}
-        self._parent = parent
+    __slots__ = ("names", "values", "parent")
+
+    def __init__(self, parent:"Environment | None"=None, names=(), values=None):
+        self.names = names
+        self.values = [UNDEFINED] * len(names) if values is None else values
+        self.parent = parent
 
     def define(self, name, value):
-        assert name not in self._values, f"`{name}` already defined."
-        self._values[name] = value
+        assert name not in self.names, f"`{name}` already defined."
+        self.names.append(name)
+        self.values.append(value)
 
-    def assign(self, name, value):
-        if name in self._values: self._values[name] = value
-        elif self._parent is not None: self._parent.assign(name, value)
-        else: assert False, f"`{name}` not defined."
+    def grow(self):
+        self.values += [UNDEFINED] * (len(self.names) - len(self.values))
 
-    def get(self, name):
-        if name in self._values: return self._values[name]
-        if self._parent is not None: return self._parent.get(name)
-        assert False, f"`{name}` not defined."
+    def ancestor(self, depth):
+        env = self
+        for _ in range(depth): env = env.parent
+        return env
 
-    def list(self):
-        parent = [] if self._parent is None else self._parent.list()
-        return parent + [self._values]
+    def get(self, slot):
+        value = self.values[slot]
+        assert value is not UNDEFINED, f"`{self.names[slot]}` not defined."
+        return value
 
-class Break(Exception): pass
-class Continue(Exception): pass
-class Return(Exception):
-    def __init__(self, value): self.value = value
+    def assign(self, slot, value):
+        assert self.values[slot] is not UNDEFINED, f"`{self.names[slot]}` not defined."
+        self.values[slot] = value
+
+    def list(self):
+        parent = [] if self.parent is None else self.parent.list()
+        pairs = list(zip(self.names, self.values))
+        scopes = [pairs] if type(self.names) is not CallNames else [pairs[:self.names.params], pairs[self.names.params:]]
+        return parent + [{ name: value for name, value in scope if value is not UNDEFINED } for scope in scopes]
+
+class Function:
+    __slots__ = ("params", "body", "names", "env", "code", "memo")
+
+    def __init__(self, params, body, names, env, code=None, memo=None):
+        self.params = params
+        self.body = body
+        self.names = names
+        self.env = env
+        self.code = code
+        self.memo = memo
+
+    def new_frame(self, args):
+        return Environment(self.env, self.names, args + [UNDEFINED] * (len(self.names) - len(args)))
+
+    def __eq__(self, other):
+        if not isinstance(other, Function): return NotImplemented
+        if type(self.code) is Arena and type(other.code) is Arena:
+            return (self.params, self.env) == (other.params, other.env) and self.code.same(self.body, other.code, other.body)
+        return (self.params, self.body, self.env) == (other.params, other.body, other.env)
+
+    __hash__ = None
+
+class Completion:
+    def __init__(self, error): self.error = error
+
+BROKE = Completion("Break at top level.")
+CONTINUED = Completion("Continue at top level.")
+RETURNED = Completion("Return from top level.")
+TAILCALLED = Completion("Tail call from top level.")
+
+class Builtin:
+    __slots__ = ("name", "arity", "func", "pure")
+
+    def __init__(self, name, arity, func, pure=False):
+        self.name = name
+        self.arity = arity
+        self.func = func
+        self.pure = pure
+
+class MemoCache:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.enabled = True
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self): return len(self._entries)
+
+    def call(self, func, args, call):
+        if (key := self.key(args)) is None: return call(func, args)
+        if (value := self.lookup(key)) is not UNDEFINED: return value
+        value = call(func, args)
+        self.store(key, value)
+        return value
 
-import inspect , operator as op
+    def key(self, args):
+        if not self.enabled or any(type(arg) is not int for arg in args): return None
+        return tuple(args)
+
+    def lookup(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return UNDEFINED
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def store(self, key, value):
+        if type(value) is Function: return
+        with self._lock:
+            self._entries[key] = value
+            if len(self._entries) > self.size: self._entries.popitem(last=False)
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+            self._entries.clear()
+
+class Memoizer:
+    # Gives an LRU cache to every function literal whose result depends only
+    # on its arguments: no print, no set outside its own frames, reads of
+    # globals that are never assigned, and calls of pure functions only.
+
+    def __init__(self, size):
+        self.caches = []
+        self._size = size
+        self._assigned = set()
+        self._dependents = {}
+
+    def memoize_program(self, program, globals_):
+        self._globals, self._funcs, self._definitions = globals_, [], {}
+        assigned = set()
+        self._collect(program, assigned)
+        for slot in assigned - self._assigned:
+            for cache in self._dependents.pop(slot, []): cache.disable()
+        self._assigned |= assigned
+
+        facts = { id(func): self._analyze(func) for func in self._funcs }
+        pure = { id(func) for func in self._funcs if facts[id(func)]["pure"] }
+        changed = True
+        while changed:
+            changed = False
+            for func in self._funcs:
+                if id(func) in pure and not all(self._is_pure_callee(slot, pure) for slot in facts[id(func)]["callees"]):
+                    pure.discard(id(func))
+                    changed = True
+
+        names = { id(func): self._globals.names[slot] for slot, func in self._definitions.items() }
+        for func in self._funcs:
+            if id(func) not in pure: continue
+            func[4] = cache = MemoCache(names.get(id(func), "<func>"), self._size)
+            self.caches.append(cache)
+            for slot in facts[id(func)]["globals"]: self._dependents.setdefault(slot, []).append(cache)
+
+    def mark_assigned(self, slots):
+        # Globals set from outside the program, like the inputs of a prepared one.
+        for slot in set(slots) - self._assigned:
+            for cache in self._dependents.pop(slot, []): cache.disable()
+        self._assigned.update(slots)
+
+    def _collect(self, node, assigned):
+        match node:
+            case ["program", *statements]:
+                for statement in statements:
+                    match statement:
+                        case ["var", slot, ["func", *_] as func]: self._definitions[slot] = func
+                    self._collect(statement, assigned)
+            case ["set", depth, slot, value]:
+                if depth == GLOBAL: assigned.add(slot)
+                self._collect(value, assigned)
+            case ["func", _, body, _, _]:
+                self._funcs.append(node)
+                self._collect(body, assigned)
+            case list():
+                for child in node: self._collect(child, assigned)
+
+    def _analyze(self, func):
+        facts = { "pure": True, "callees": set(), "globals": set() }
+        self._walk(func[2], 0, facts)
+        facts["pure"] = facts["pure"] and not (facts["globals"] & self._assigned)
+        return facts
+
+    def _walk(self, node, frames, facts):
+        match node:
+            case ["print", _]: facts["pure"] = False
+            case ["set", depth, _, value]:
+                if depth == GLOBAL or depth > frames: facts["pure"] = False
+                self._walk(value, frames, facts)
+            case ["$get", depth, slot]:
+                if depth == GLOBAL: facts["globals"].add(slot)
+                elif depth > frames: facts["pure"] = False
+            case ["block", _, *statements]:
+                for statement in statements: self._walk(statement, frames + 1, facts)
+            case ["func", _, body, _, _]: self._walk(body, frames + 1, facts)
+            case ["tailcall", *call]: self._walk(call, frames, facts)
+            case [str(), *children]:
+                for child in children: self._walk(child, frames, facts)
+            case [callee, *args]:
+                match callee:
+                    case ["$get", depth, slot] if depth == GLOBAL: facts["callees"].add(slot)
+                    case _: facts["pure"] = False
+                for child in node: self._walk(child, frames, facts)
+
+    def _is_pure_callee(self, slot, pure):
+        if slot in self._assigned: return False
+        if slot in self._definitions: return id(self._definitions[slot]) in pure
+        match self._globals.values[slot]:
+            case Builtin(pure=True): return True
+            case Function(memo=MemoCache(enabled=True)): return True
+            case _: return False
+
+from functools import partial
+
+class Context:
+    # The state of one run: its globals, the innermost scope, what it
+    # printed and what a call is handing back to its caller. Evaluators keep
+    # no state of their own while running, so runs of one prepared program
+    # may go on in many threads at once, and a failed run leaves nothing
+    # behind.
+    __slots__ = ("globals", "env", "output", "source", "return_value", "tail_call", "arena", "statements")
+
+    def __init__(self, globals_, output, source):
+        self.globals = self.env = globals_
+        self.output = output
+        self.source = source
+        self.return_value = None
+        self.tail_call = None
+        self.arena = None
+        self.statements = 0
 
 class Evaluator:
-    def __init__(self):
+    def __init__(self, optimize=False, memoize=False, memo_size=1024, count=False):
+        # With count=True, statements counts every statement run, blocks
+        # and function bodies included.
         self._output = []
-        self._env = Environment()
-        self._env.define("less", lambda a, b: self._calc(op.lt, a, b))
-        self._env.define("print_env", self._print_env)
+        self._optimize = optimize
+        self._count = count
+        self.statements = 0
+        self._statements_lock = threading.Lock()
+        if count: self._eval_statement = self._counted(self._eval_statement)
+        self._running = threading.local()
+        self._source = SourceMap("")
+        self._resolver = None
+        self._frame_per_block = False
+        self._globals = Environment(names=[], values=[])
+        self._memoizer = Memoizer(memo_size) if memoize else None
+        self.register_builtin("less", 2, lambda a, b: self._calc(op.lt, a, b), pure=True)
+        self.register_builtin("print_env", 0, self._print_env)
 
     def clear_output(self): self._output = []
     def output(self): return self._output
+    def memo_caches(self): return [] if self._memoizer is None else self._memoizer.caches
+
+    def _counted(self, run):
+        def counted(context, statement):
+            context.statements += 1
+            return run(context, statement)
+        return counted
+
+    def register_builtin(self, name, arity, func, pure=False):
+        self._globals.define(name, Builtin(name, arity, func, pure))
 
     def _print_env(self):
-        for values in self._env.list():
+        for values in self._running.context.env.list():
             print({ k: self._to_print(v) for k, v in values.items() })
 
-    def eval_program(self, program):
+    def eval_stream(self, statements, source=None):
+        # Runs top-level statements one at a time as they come and yields what
+        # each printed. One Resolver sees them all, so a function may still
+        # call one defined after it.
+        self._resolver = Resolver(self._globals.names, source, forward=True, frame_per_block=self._frame_per_block)
         try:
-            match program:
-                case ["program", *statements]:
-                    for statement in statements: self._eval_statement(statement)
-                case unexpected: assert False, f"Internal Error at `{unexpected}`."
-        except Return: assert False, "Return from top level."
-        except Break: assert False, "Break at top level."
-        except Continue: assert False, "Continue at top level."
-
-    def _eval_statement(self, statement):
-        match statement:
-            case ["block", *statements]: self._eval_block(statements)
-            case ["var", name, value]: self._eval_var(name, value)
-            case ["set", name, value]: self._eval_set(name, value)
-            case ["if", cond, conseq, alt]: self._eval_if(cond, conseq, alt)
-            case ["while", cond, body, then]: self._eval_while(cond, body, then)
-            case ["for", init_name, init_exp, cond, update_name, update_exp, body]:
-                self._eval_for(init_name, init_exp, cond, update_name, update_exp, body)
-            case ["break"]: raise Break()
-            case ["continue"]: raise Continue()
-            case ["return", value]: raise Return(self._eval_expr(value))
-            case ["print", expr]: self._eval_print(expr)
-            case ["expr", expr]: self._eval_expr(expr)
-            case unexpected: assert False, f"Internal Error at `{unexpected}`."
-
-    def _eval_block(self, statements):
-        parent_env = self._env
-        self._env = Environment(parent_env)
-        for statement in statements:
-            self._eval_statement(statement)
-        self._env = parent_env
-
-    def _eval_var(self, name, value):
-        self._env.define(name, self._eval_expr(value))
+            for statement in statements:
+                self.eval_program(["program", statement], source)
+                if source is not None: source.forget()
+                output = self.output()
+                self.clear_output()
+                yield output
+            self._resolver.check_forward_names()
+        finally: self._resolver = None
+
+    def _prepare(self, program, source, globals_, inputs=()):
+        # Globals left undefined by a failed program may be declared again;
+        # inputs count as declared.
+        self._source = SourceMap("") if source is None else source
+        resolver = self._new_resolver(globals_, inputs)
+        program = resolver.resolve_program(program)
+        self._frame_per_block = resolver.frame_per_block
+        if self._optimize: program = Optimizer(self._source).optimize_program(program)
+        globals_.grow()
+        if self._memoizer is not None:
+            # A prepared program starts the globals it adds afresh every run,
+            # so any of them may differ from one run to the next.
+            if globals_ is not self._globals: self._memoizer.mark_assigned(range(len(self._globals.names), len(globals_.names)))
+            self._memoizer.memoize_program(program, globals_)
+        return program
 
-    def _eval_set(self, name, value):
-        self._env.assign(name, self._eval_expr(value))
+    def _new_resolver(self, globals_, inputs):
+        if self._resolver is not None: return self._resolver
+        declared = [name for name, value in zip(globals_.names, globals_.values) if value is not UNDEFINED]
+        return Resolver(globals_.names, self._source, declared=declared + list(inputs), frame_per_block=self._frame_per_block)
+
+    def eval_program(self, program, source=None):
+        run = self._compile(program, source, self._globals)
+        self._run(run, Context(self._globals, self._output, self._source))
+
+    def prepare(self, program, source=None, inputs=()):
+        # Resolves, optimizes and compiles program once, for PreparedProgram
+        # to run many times. inputs are globals that each run binds. The
+        # program's globals go into a copy, leaving the evaluator's alone.
+        globals_ = Environment(names=list(self._globals.names), values=list(self._globals.values))
+        for name in inputs:
+            if name not in globals_.names: globals_.define(name, UNDEFINED)
+        slots = {name: globals_.names.index(name) for name in inputs}
+        if self._memoizer is not None: self._memoizer.mark_assigned(slots.values())
+        run = self._compile(program, source, globals_, inputs)
+        return PreparedProgram(self, run, self._source, globals_.names, tuple(globals_.values), slots)
+
+    def _run_prepared(self, run, source, names, values):
+        context = Context(Environment(names=names, values=values), [], source)
+        self._run(run, context)
+        return context.output
+
+    def _compile(self, program, source, globals_, inputs=()):
+        # Programs nested deeper than the Python stack allows, as
+        # IterativeParser may give, fail here rather than with a traceback.
+        try: return self._compile_program(self._prepare(program, source, globals_, inputs))
+        except RecursionError: pass
+        assert False, f"Nesting too deep."
+
+    def _run(self, run, context):
+        # Builtins such as print_env find the context of their thread's run
+        # in _running.
+        previous, self._running.context = getattr(self._running, "context", None), context
+        try:
+            run(context)
+            overflowed = False
+        except RecursionError: overflowed = True
+        finally:
+            self._running.context = previous
+            if self._count:
+                with self._statements_lock: self.statements += context.statements
+        assert not overflowed, f"Stack overflow."
+
+    def _compile_program(self, program):
+        match program:
+            case ["program", *statements]:
+                def run(context):
+                    completion = self._eval_statements(context, statements)
+                    assert completion is None, completion.error
+                return run
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
 
-    def _eval_if(self, cond, conseq, alt):
-        if self._eval_expr(cond):
-            self._eval_statement(conseq)
-        else:
-            self._eval_statement(alt)
+    def _eval_statement(self, context, statement):
+        match statement:
+            case ["block", names, *statements]: return self._eval_block(context, names, statements)
+            case ["seq", *statements]: return self._eval_statements(context, statements)
+            case ["var", slot, value]: self._eval_var(context, slot, value)
+            case ["set", depth, slot, value]: self._eval_set(context, depth, slot, value)
+            case ["if", cond, conseq, alt]: return self._eval_if(context, cond, conseq, alt)
+            case ["while", cond, body, then]: return self._eval_while(context, cond, body, then)
+            case ["for", init, cond, update, body]: return self._eval_for(context, init, cond, update, body)
+            case ["break"]: return BROKE
+            case ["continue"]: return CONTINUED
+            case ["return", value]: return self._eval_return(context, value)
+            case ["tailcall", func, *args]: return self._eval_tailcall(context, func, args)
+            case ["print", expr]: self._eval_print(context, expr)
+            case ["expr", expr]: self._eval_expr(context, expr)
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
 
-    def _eval_while(self, cond, body, then):
-        while self._eval_expr(cond):
-            try: self._eval_statement(body)
-            except Continue: continue
-            except Break: break
+    def _eval_statements(self, context, statements):
+        try:
+            for statement in statements:
+                if (completion := self._eval_statement(context, statement)) is not None: return completion
+        except AssertionError as e: raise context.source.locate_node(e, statement)
+        return None
+
+    def _eval_block(self, context, names, statements):
+        parent_env = context.env
+        context.env = Environment(parent_env, names)
+        try: return self._eval_statements(context, statements)
+        finally: context.env = parent_env
+
+    def _eval_var(self, context, slot, value):
+        context.env.values[slot] = self._eval_expr(context, value)
+
+    def _eval_set(self, context, depth, slot, value):
+        self._scope(context, depth).assign(slot, self._eval_expr(context, value))
+
+    def _eval_if(self, context, cond, conseq, alt):
+        if self._eval_expr(context, cond):
+            return self._eval_statement(context, conseq)
         else:
-            self._eval_statement(then)
-
-    def _eval_for(self, init_name, init_exp, cond, update_name, update_exp, body):
-        self._eval_var(init_name, init_exp)
-        while self._eval_expr(cond):
-            try:
-                self._eval_statement(body)
-                self._eval_set(update_name, update_exp)
-            except Continue:
-                self._eval_set(update_name, update_exp)
-                continue
-            except Break: break
-
-    def _eval_print(self, expr):
-        self._output.append(self._to_print(self._eval_expr(expr)))
+            return self._eval_statement(context, alt)
+
+    def _eval_while(self, context, cond, body, then):
+        while self._eval_expr(context, cond):
+            completion = self._eval_statement(context, body)
+            if completion is BROKE: return None
+            if completion is not None and completion is not CONTINUED: return completion
+        return self._eval_statement(context, then)
+
+    def _eval_for(self, context, init, cond, update, body):
+        self._eval_statement(context, init)
+        while self._eval_expr(context, cond):
+            completion = self._eval_statement(context, body)
+            if completion is BROKE: return None
+            if completion is not None and completion is not CONTINUED: return completion
+            self._eval_statement(context, update)
+        return None
+
+    def _eval_return(self, context, value):
+        context.return_value = self._eval_expr(context, value)
+        return RETURNED
+
+    def _eval_tailcall(self, context, func, args):
+        func, args = self._eval_expr(context, func), [self._eval_expr(context, arg) for arg in args]
+        if type(func) is Builtin:
+            context.return_value = self._apply(context, func, args)
+            return RETURNED
+        assert len(func.params) == len(args), f"Parameter's count doesn't match."
+        context.tail_call = func, args
+        return TAILCALLED
+
+    def _eval_print(self, context, expr):
+        context.output.append(self._to_print(self._eval_expr(context, expr)))
 
     def _to_print(self, value):
         match value:
             case None: return "null"
             case bool(b): return "true" if b else "false"
-            case v if callable(v): return "<builtin>"
-            case ["func", *_]: return "<func>"
+            case Builtin(): return "<builtin>"
+            case Function(): return "<func>"
             case _: return value
 
-    def _eval_expr(self, expr):
+    def _eval_expr(self, context, expr):
         match expr:
             case None: return None
             case int(value) | bool(value): return value
-            case str(name): return self._eval_variable(name)
-            case ["func", param, body]: return ["func", param, body, self._env]
-            case ["-", a]: return self._unary_minus(a)
-            case ["^", a, b]: return self._apply_calc(op.pow, a, b)
-            case ["*", a, b]: return self._apply_calc(op.mul, a, b)
-            case ["/", a, b]: return self._apply_calc(self._div, a, b)
-            case ["+", a, b]: return self._apply_calc(op.add, a, b)
-            case ["-", a, b]: return self._apply_calc(op.sub, a, b)
-            case ["<", a, b]: return self._apply_calc(op.lt, a, b)
-            case ["<=", a, b]: return self._apply_calc(op.le, a, b)
-            case [">", a, b]: return self._apply_calc(op.gt, a, b)
-            case [">=", a, b]: return self._apply_calc(op.ge, a, b)
-            case ["=", a, b]: return self._eval_expr(a) == self._eval_expr(b)
-            case ["#", a, b]: return self._eval_expr(a) != self._eval_expr(b)
-            case ["&", a, b]: return self._eval_expr(a) and self._eval_expr(b)
-            case ["|", a, b]: return self._eval_expr(a) or self._eval_expr(b)
-            case ["?", cond, conseq, alt]: return self._eval_ternary(cond, conseq, alt)
+            case ["$get", depth, slot]: return self._eval_variable(context, depth, slot)
+            case ["func", params, body, names, memo]: return Function(params, body, names, context.env, memo=memo)
+            case ["-", a]: return self._unary_minus(context, a)
+            case ["^", a, b]: return self._apply_calc(context, op.pow, a, b)
+            case ["*", a, b]: return self._apply_calc(context, op.mul, a, b)
+            case ["/", a, b]: return self._apply_calc(context, self._div, a, b)
+            case ["+", a, b]: return self._apply_calc(context, op.add, a, b)
+            case ["-", a, b]: return self._apply_calc(context, op.sub, a, b)
+            case ["<", a, b]: return self._apply_calc(context, op.lt, a, b)
+            case ["<=", a, b]: return self._apply_calc(context, op.le, a, b)
+            case [">", a, b]: return self._apply_calc(context, op.gt, a, b)
+            case [">=", a, b]: return self._apply_calc(context, op.ge, a, b)
+            case ["=", a, b]: return self._eval_expr(context, a) == self._eval_expr(context, b)
+            case ["#", a, b]: return self._eval_expr(context, a) != self._eval_expr(context, b)
+            case ["&", a, b]: return self._eval_expr(context, a) and self._eval_expr(context, b)
+            case ["|", a, b]: return self._eval_expr(context, a) or self._eval_expr(context, b)
+            case ["?", cond, conseq, alt]: return self._eval_ternary(context, cond, conseq, alt)
             case [func, *args]:
-                return self._apply(self._eval_expr(func), [self._eval_expr(arg) for arg in args])
+                return self._apply(context, self._eval_expr(context, func), [self._eval_expr(context, arg) for arg in args])
             case unexpected: assert False, f"Unexpected expression at `{unexpected}`."
 
-    def _unary_minus(self, a):
-        a = self._eval_expr(a)
+    def _unary_minus(self, context, a):
+        a = self._eval_expr(context, a)
         assert isinstance(a, int), f"Operand must be integer."
         return -a
 
@@ -419,67 +1866,998 @@ class Evaluator:
         assert b != 0, f"Division by zero."
         return a // b
 
-    def _apply_calc(self, op, a, b):
-        a, b = self._eval_expr(a), self._eval_expr(b)
+    def _apply_calc(self, context, op, a, b):
+        a, b = self._eval_expr(context, a), self._eval_expr(context, b)
         return self._calc(op, a, b)
 
     def _calc(self, op, a, b):
         assert isinstance(a, int) and isinstance(b, int), f"Operands must be integers."
         return op(a, b)
 
-    def _apply(self, func, args):
-        if callable(func):
-            parameters = inspect.signature(func).parameters
-            assert len(parameters) == len(args), f"Parameter's count doesn't match."
-            return func(*args)
+    def _apply(self, context, func, args):
+        if type(func) is Builtin:
+            assert func.arity == len(args), f"Parameter's count doesn't match."
+            return func.func(*args)
 
-        [_, parameters, body, env] = func
-        parent_env = self._env
-        assert len(parameters) == len(args), f"Parameter's count doesn't match."
-        self._env = Environment(env)
-        for param, arg in zip(parameters, args): self._env.define(param, arg)
+        assert len(func.params) == len(args), f"Parameter's count doesn't match."
+        if func.memo is not None: return func.memo.call(func, args, partial(self._apply_function, context))
+        return self._apply_function(context, func, args)
 
-        value = None
-        try: self._eval_statement(body)
-        except Return as ret: value = ret.value
-        self._env = parent_env
-        return value
+    def _apply_function(self, context, func, args):
+        parent_env = context.env
+        context.env = func.new_frame(args)
+        try:
+            while (completion := self._eval_statement(context, func.body)) is TAILCALLED:
+                func, args = context.tail_call
+                context.env = func.new_frame(args)
+        finally: context.env = parent_env
+        if completion is RETURNED: return context.return_value
+        assert completion is None, completion.error
+        return None
+
+    def _eval_ternary(self, context, cond, conseq, alt):
+        cond = self._eval_expr(context, cond)
+        return self._eval_expr(context, conseq) if cond else self._eval_expr(context, alt)
+
+    def _eval_variable(self, context, depth, slot):
+        return self._scope(context, depth).get(slot)
+
+    def _scope(self, context, depth):
+        return context.globals if depth == GLOBAL else context.env.ancestor(depth)
+
+class PreparedProgram:
+    # A program that an evaluator has resolved, optimized and compiled, like
+    # a prepared statement. Each run starts from the globals as they were
+    # when it was prepared, with the inputs bound, and gives what it
+    # printed; runs do not see each other's variables. Inputs left unbound
+    # are not defined. Each run has a Context of its own, so a prepared
+    # program may run in many threads at once; preparing is not thread-safe.
+
+    def __init__(self, evaluator, run, source, names, values, slots):
+        self._evaluator = evaluator
+        self._run = run
+        self._source = source
+        self._names = names
+        self._values = values
+        self._slots = slots
+
+    @property
+    def inputs(self): return tuple(self._slots)
+
+    def run(self, bindings=None):
+        values = list(self._values)
+        if bindings is not None:
+            for name, value in bindings.items():
+                assert name in self._slots, f"`{name}` is not an input."
+                values[self._slots[name]] = value
+        return self._evaluator._run_prepared(self._run, self._source, self._names, values)
+
+class ClosureEvaluator(Evaluator):
+    def _compile_program(self, program):
+        match program:
+            case ["program", *statements]: code = self._compile_statements(statements)
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+        def run(context):
+            completion = code(context, context.globals)
+            assert completion is None, completion.error
+        return run
+
+    def _compile_statements(self, statements):
+        codes = [self._compile_statement(statement) for statement in statements]
+        source = self._source
+        def run(context, env):
+            try:
+                for code in codes:
+                    if (completion := code(context, env)) is not None: return completion
+            except AssertionError as e: raise source.locate_node(e, statements[codes.index(code)])
+            return None
+        return run
 
-    def _eval_ternary(self, cond, conseq, alt):
-        cond = self._eval_expr(cond)
-        return self._eval_expr(conseq) if cond else self._eval_expr(alt)
+    def _compile_statement(self, statement):
+        code = self._build_statement(statement)
+        return self._counted(code) if self._count else code
 
-    def _eval_variable(self, name):
-        return self._env.get(name)
+    def _build_statement(self, statement):
+        match statement:
+            case ["block", names, *statements]: return self._compile_block(names, statements)
+            case ["seq", *statements]: return self._compile_statements(statements)
+            case ["var", slot, value]: return self._compile_var(slot, value)
+            case ["set", depth, slot, value]: return self._compile_set(depth, slot, value)
+            case ["if", cond, conseq, alt]: return self._compile_if(cond, conseq, alt)
+            case ["while", cond, body, then]: return self._compile_while(cond, body, then)
+            case ["for", init, cond, update, body]: return self._compile_for(init, cond, update, body)
+            case ["break"]: return self._compile_break()
+            case ["continue"]: return self._compile_continue()
+            case ["return", value]: return self._compile_return(value)
+            case ["tailcall", func, *args]: return self._compile_tailcall(func, args)
+            case ["print", expr]: return self._compile_print(expr)
+            case ["expr", expr]: return self._compile_expression_statement(expr)
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+
+    def _compile_block(self, names, statements):
+        run = self._compile_statements(statements)
+        def block(context, env): return run(context, Environment(env, names))
+        return block
+
+    def _compile_var(self, slot, value):
+        value = self._compile_expr(value)
+        def var(context, env): env.values[slot] = value(context, env)
+        return var
+
+    def _compile_set(self, depth, slot, value):
+        value = self._compile_expr(value)
+        if depth == 0:
+            def set_local(context, env): env.values[slot] = value(context, env)
+            return set_local
+        if depth == GLOBAL:
+            def set_global(context, env): context.globals.assign(slot, value(context, env))
+            return set_global
+        def set_(context, env): env.ancestor(depth).assign(slot, value(context, env))
+        return set_
+
+    def _compile_if(self, cond, conseq, alt):
+        cond, conseq, alt = self._compile_expr(cond), self._compile_statement(conseq), self._compile_statement(alt)
+        def if_(context, env):
+            if cond(context, env): return conseq(context, env)
+            else: return alt(context, env)
+        return if_
+
+    def _compile_while(self, cond, body, then):
+        cond, body, then = self._compile_expr(cond), self._compile_statement(body), self._compile_statement(then)
+        def while_(context, env):
+            while cond(context, env):
+                completion = body(context, env)
+                if completion is BROKE: return None
+                if completion is not None and completion is not CONTINUED: return completion
+            return then(context, env)
+        return while_
+
+    def _compile_for(self, init, cond, update, body):
+        init, update = self._compile_statement(init), self._compile_statement(update)
+        cond, body = self._compile_expr(cond), self._compile_statement(body)
+        def for_(context, env):
+            init(context, env)
+            while cond(context, env):
+                completion = body(context, env)
+                if completion is BROKE: return None
+                if completion is not None and completion is not CONTINUED: return completion
+                update(context, env)
+            return None
+        return for_
+
+    def _compile_break(self): return lambda context, env: BROKE
+    def _compile_continue(self): return lambda context, env: CONTINUED
+
+    def _compile_return(self, value):
+        value = self._compile_expr(value)
+        def return_(context, env):
+            context.return_value = value(context, env)
+            return RETURNED
+        return return_
+
+    def _compile_tailcall(self, func, args):
+        func, args = self._compile_expr(func), [self._compile_expr(arg) for arg in args]
+        call = self._call
+        def tailcall(context, env):
+            callee, values = func(context, env), [arg(context, env) for arg in args]
+            if type(callee) is Builtin:
+                context.return_value = call(context, callee, values, env)
+                return RETURNED
+            assert len(callee.params) == len(values), f"Parameter's count doesn't match."
+            context.tail_call = callee, values
+            return TAILCALLED
+        return tailcall
+
+    def _compile_print(self, expr):
+        expr, to_print = self._compile_expr(expr), self._to_print
+        def print_(context, env): context.output.append(to_print(expr(context, env)))
+        return print_
+
+    def _compile_expression_statement(self, expr):
+        expr = self._compile_expr(expr)
+        def expression_statement(context, env): expr(context, env)
+        return expression_statement
+
+    def _compile_expr(self, expr):
+        match expr:
+            case None | int() | bool(): return lambda context, env: expr
+            case ["$get", depth, slot]: return self._compile_variable(depth, slot)
+            case ["func", params, body, names, memo]: return self._compile_func(params, body, names, memo)
+            case ["-", a]: return self._compile_unary_minus(a)
+            case ["^", a, b]: return self._compile_calc(op.pow, a, b)
+            case ["*", a, b]: return self._compile_calc(op.mul, a, b)
+            case ["/", a, b]: return self._compile_calc(self._div, a, b)
+            case ["+", a, b]: return self._compile_calc(op.add, a, b)
+            case ["-", a, b]: return self._compile_calc(op.sub, a, b)
+            case ["<", a, b]: return self._compile_calc(op.lt, a, b)
+            case ["<=", a, b]: return self._compile_calc(op.le, a, b)
+            case [">", a, b]: return self._compile_calc(op.gt, a, b)
+            case [">=", a, b]: return self._compile_calc(op.ge, a, b)
+            case ["=", a, b]: return self._compile_equality(op.eq, a, b)
+            case ["#", a, b]: return self._compile_equality(op.ne, a, b)
+            case ["&", a, b]: return self._compile_and(a, b)
+            case ["|", a, b]: return self._compile_or(a, b)
+            case ["?", cond, conseq, alt]: return self._compile_ternary(cond, conseq, alt)
+            case [func, *args]: return self._compile_call(func, args)
+            case unexpected: assert False, f"Unexpected expression at `{unexpected}`."
+
+    def _compile_variable(self, depth, slot):
+        if depth == 0:
+            def get_local(context, env):
+                value = env.values[slot]
+                assert value is not UNDEFINED, f"`{env.names[slot]}` not defined."
+                return value
+            return get_local
+        if depth == GLOBAL: return lambda context, env: context.globals.get(slot)
+        return lambda context, env: env.ancestor(depth).get(slot)
+
+    def _compile_func(self, params, body, names, memo):
+        code = self._compile_statement(body)
+        return lambda context, env: Function(params, body, names, env, code, memo)
+
+    def _compile_unary_minus(self, a):
+        a = self._compile_expr(a)
+        def unary_minus(context, env):
+            value = a(context, env)
+            assert isinstance(value, int), f"Operand must be integer."
+            return -value
+        return unary_minus
+
+    def _compile_calc(self, op, a, b):
+        a, b = self._compile_expr(a), self._compile_expr(b)
+        def calc(context, env):
+            x, y = a(context, env), b(context, env)
+            assert isinstance(x, int) and isinstance(y, int), f"Operands must be integers."
+            return op(x, y)
+        return calc
+
+    def _compile_equality(self, op, a, b):
+        a, b = self._compile_expr(a), self._compile_expr(b)
+        return lambda context, env: op(a(context, env), b(context, env))
+
+    def _compile_and(self, a, b):
+        a, b = self._compile_expr(a), self._compile_expr(b)
+        return lambda context, env: a(context, env) and b(context, env)
+
+    def _compile_or(self, a, b):
+        a, b = self._compile_expr(a), self._compile_expr(b)
+        return lambda context, env: a(context, env) or b(context, env)
+
+    def _compile_ternary(self, cond, conseq, alt):
+        cond, conseq, alt = self._compile_expr(cond), self._compile_expr(conseq), self._compile_expr(alt)
+        return lambda context, env: conseq(context, env) if cond(context, env) else alt(context, env)
+
+    def _compile_call(self, func, args):
+        func, args = self._compile_expr(func), [self._compile_expr(arg) for arg in args]
+        call = self._call
+        return lambda context, env: call(context, func(context, env), [arg(context, env) for arg in args], env)
+
+    def _call(self, context, func, args, env):
+        if type(func) is Builtin:
+            assert func.arity == len(args), f"Parameter's count doesn't match."
+            context.env = env
+            return func.func(*args)
+
+        assert len(func.params) == len(args), f"Parameter's count doesn't match."
+        if func.memo is not None: return func.memo.call(func, args, partial(self._call_function, context))
+        return self._call_function(context, func, args)
+
+    def _call_function(self, context, func, args):
+        completion = func.code(context, func.new_frame(args))
+        while completion is TAILCALLED:
+            func, args = context.tail_call
+            completion = func.code(context, func.new_frame(args))
+        if completion is RETURNED: return context.return_value
+        assert completion is None, completion.error
+        return None
+
+(CONST, LOAD_LOCAL, LOAD_GLOBAL, LOAD_DEREF, STORE_LOCAL, STORE_GLOBAL, STORE_DEREF, POP, ENTER, LEAVE,
+ JUMP, JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, NEG, CALC, EQ, NE, FUNC, CALL, RETURN,
+ PRINT, FAIL, TAIL_CALL, COUNT) = range(25)
+
+class ArenaEvaluator(Evaluator):
+    # Runs from Arenas instead of lists. A program, given as lists or as the
+    # Arena that Parser builds, is resolved as lists as usual; the result is
+    # flattened into an Arena of its own and the lists are dropped. The
+    # evaluator then walks the Arena by index, so a large program leaves no
+    # tree of Python objects behind. A function keeps its Arena in code.
+
+    def _prepare(self, program, source, globals_, inputs=()):
+        # An Arena from Parser is resolved a top-level statement at a time,
+        # each going into the Arena that runs as soon as it is resolved, so
+        # the program never exists as lists as a whole. Memoizing needs the
+        # whole program, so with it the Arena is turned into lists first.
+        if not isinstance(program, Arena): return super()._prepare(program, source, globals_, inputs)
+        self._source = SourceMap("") if source is None else source
+        if self._memoizer is not None: return super()._prepare(program.to_lists(source=self._source), self._source, globals_, inputs)
+        resolver = self._new_resolver(globals_, inputs)
+        statements = list(program.children(len(program) - 1))
+        names = [program.value(program.first_children[index]) for index in statements
+                 if program.kinds[index] in (Arena.VAR, Arena.FOR)]
+        resolver.begin_program(names, "print_env" in program.constants)
+        resolved = Arena(self._source)
+        resolved.add_program(self._resolve_statements(resolver, program, statements))
+        resolver.end_program()
+        self._frame_per_block = resolver.frame_per_block
+        globals_.grow()
+        return resolved
+
+    def _resolve_statements(self, resolver, program, statements):
+        optimizer = Optimizer(self._source) if self._optimize else None
+        for index in statements:
+            statement = resolver.resolve_statement(program.to_lists(index, self._source))
+            if optimizer is None: yield statement
+            else: yield from optimizer.optimize_program(["program", statement])[1:]
+            del statement
+            self._source.forget()
+
+    def _compile_program(self, program):
+        if isinstance(program, Arena): arena = program
+        else:
+            arena = Arena(self._source)
+            arena.add(program, True)
+        del program
+        statements = arena.first_children[len(arena) - 1]
+        self._source.forget()
+        def run(context):
+            context.arena = arena
+            completion = self._eval_statements(context, statements)
+            assert completion is None, completion.error
+        return run
+
+    def _eval_statements(self, context, index):
+        arena = context.arena
+        try:
+            while index >= 0:
+                if (completion := self._eval_statement(context, index)) is not None: return completion
+                index = arena.next_siblings[index]
+        except AssertionError as e:
+            raise context.source.locate(e, arena.offsets.get(index) if arena.source is context.source else None)
+        return None
+
+    def _eval_statement(self, context, index):
+        arena = context.arena
+        child, next_siblings, operands = arena.first_children[index], arena.next_siblings, arena.operands
+        match arena.kinds[index]:
+            case Arena.BLOCK: return self._eval_block(context, arena.value(child), next_siblings[child])
+            case Arena.SEQ: return self._eval_statements(context, child)
+            case Arena.VAR: self._eval_var(context, operands[child], next_siblings[child])
+            case Arena.SET:
+                slot = next_siblings[child]
+                self._eval_set(context, operands[child], operands[slot], next_siblings[slot])
+            case Arena.IF:
+                conseq = next_siblings[child]
+                return self._eval_if(context, child, conseq, next_siblings[conseq])
+            case Arena.WHILE:
+                body = next_siblings[child]
+                return self._eval_while(context, child, body, next_siblings[body])
+            case Arena.FOR: return self._eval_for(context, *arena.children(index))
+            case Arena.BREAK: return BROKE
+            case Arena.CONTINUE: return CONTINUED
+            case Arena.RETURN: return self._eval_return(context, child)
+            case Arena.TAILCALL: return self._eval_tailcall(context, child, list(arena.children(index))[1:])
+            case Arena.PRINT: self._eval_print(context, child)
+            case Arena.EXPR: self._eval_expr(context, child)
+            case kind: assert False, f"Internal Error at `{Arena.TAGS[kind]}`."
+
+    def _eval_expr(self, context, index):
+        arena = context.arena
+        child, next_siblings = arena.first_children[index], arena.next_siblings
+        match arena.kinds[index]:
+            case Arena.INT: return arena.operands[index]
+            case Arena.VALUE: return arena.constants[arena.operands[index]]
+            case Arena.GET: return self._eval_variable(context, arena.operands[child], arena.operands[next_siblings[child]])
+            case Arena.FUNC:
+                params, body, names, memo = arena.children(index)
+                return Function(arena.value(params), body, arena.value(names), context.env, arena, arena.value(memo))
+            case Arena.MINUS if next_siblings[child] < 0: return self._unary_minus(context, child)
+            case Arena.CARET: return self._apply_calc(context, op.pow, child, next_siblings[child])
+            case Arena.STAR: return self._apply_calc(context, op.mul, child, next_siblings[child])
+            case Arena.SLASH: return self._apply_calc(context, self._div, child, next_siblings[child])
+            case Arena.PLUS: return self._apply_calc(context, op.add, child, next_siblings[child])
+            case Arena.MINUS: return self._apply_calc(context, op.sub, child, next_siblings[child])
+            case Arena.LT: return self._apply_calc(context, op.lt, child, next_siblings[child])
+            case Arena.LE: return self._apply_calc(context, op.le, child, next_siblings[child])
+            case Arena.GT: return self._apply_calc(context, op.gt, child, next_siblings[child])
+            case Arena.GE: return self._apply_calc(context, op.ge, child, next_siblings[child])
+            case Arena.EQ: return self._eval_expr(context, child) == self._eval_expr(context, next_siblings[child])
+            case Arena.NE: return self._eval_expr(context, child) != self._eval_expr(context, next_siblings[child])
+            case Arena.AND: return self._eval_expr(context, child) and self._eval_expr(context, next_siblings[child])
+            case Arena.OR: return self._eval_expr(context, child) or self._eval_expr(context, next_siblings[child])
+            case Arena.QUESTION:
+                conseq = next_siblings[child]
+                return self._eval_ternary(context, child, conseq, next_siblings[conseq])
+            case Arena.CALL:
+                func, *args = [self._eval_expr(context, expr) for expr in arena.children(index)]
+                return self._apply(context, func, args)
+            case kind: assert False, f"Unexpected expression at `{Arena.TAGS[kind]}`."
+
+    def _apply_function(self, context, func, args):
+        parent_env, parent_arena = context.env, context.arena
+        context.env, context.arena = func.new_frame(args), func.code
+        try:
+            while (completion := self._eval_statement(context, func.body)) is TAILCALLED:
+                func, args = context.tail_call
+                context.env, context.arena = func.new_frame(args), func.code
+        finally: context.env, context.arena = parent_env, parent_arena
+        if completion is RETURNED: return context.return_value
+        assert completion is None, completion.error
+        return None
+
+CALC_OPS = ("^", "*", "/", "+", "-", "<", "<=", ">", ">=")
+
+class Code:
+    # Offsets of statements are kept in a table of (pc, offset) like a line
+    # number table; the last entry at or before a pc tells where it came from.
+
+    def __init__(self, source):
+        self.instructions = []
+        self.constants = []
+        self.source = source
+        self._pcs, self._offsets = array("i"), []
+        self._indexes = {}
+
+    def emit(self, instruction, arg=0):
+        self.instructions += (instruction, arg)
+        return len(self.instructions) - 2
+
+    def constant(self, value):
+        if isinstance(value, tuple):
+            self.constants.append(value)
+            return len(self.constants) - 1
+        key = (type(value), value)
+        if key not in self._indexes:
+            self._indexes[key] = len(self.constants)
+            self.constants.append(value)
+        return self._indexes[key]
+
+    def here(self): return len(self.instructions)
+
+    def patch(self, at, target): self.instructions[at + 1] = target
+
+    def mark(self, offset):
+        if self._pcs and self._pcs[-1] == self.here(): self._offsets[-1] = offset
+        else:
+            self._pcs.append(self.here())
+            self._offsets.append(offset)
+
+    def locate(self, error, pc):
+        index = bisect_right(self._pcs, pc) - 1
+        return error if index < 0 else self.source.locate(error, self._offsets[index])
+
+class Compiler:
+    def __init__(self, source=None, count=False):
+        self._source = SourceMap("") if source is None else source
+        self._count = count
+        self._code = Code(self._source)
+        self._offset = None
+        self._loops = []
+        self._block_depth = 0
+        self._in_function = False
+
+    def compile_program(self, program):
+        match program:
+            case ["program", *statements]:
+                for statement in statements: self._compile_statement(statement)
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+        return self._code
+
+    def _compile_function(self, params, body, names, memo):
+        compiler = Compiler(self._source, self._count)
+        compiler._in_function = True
+        compiler._compile_statement(body)
+        compiler._code.emit(CONST, compiler._code.constant(None))
+        compiler._code.emit(RETURN)
+        return (params, body, names, compiler._code, memo)
+
+    def _compile_statement(self, statement):
+        enclosing = self._offset
+        self._offset = self._source.offset(statement, enclosing)
+        self._code.mark(self._offset)
+        if self._count: self._code.emit(COUNT)
+        self._emit_statement(statement)
+        self._offset = enclosing
+        self._code.mark(enclosing)
+
+    def _emit_statement(self, statement):
+        match statement:
+            case ["block", names, *statements]: self._compile_block(names, statements)
+            case ["seq", *statements]:
+                for statement in statements: self._compile_statement(statement)
+            case ["var", slot, value]: self._compile_store(0, slot, value)
+            case ["set", depth, slot, value]: self._compile_store(depth, slot, value)
+            case ["if", cond, conseq, alt]: self._compile_if(cond, conseq, alt)
+            case ["while", cond, body, then]: self._compile_while(cond, body, then)
+            case ["for", init, cond, update, body]: self._compile_for(init, cond, update, body)
+            case ["break"]: self._compile_jump_out("break", "Break at top level.")
+            case ["continue"]: self._compile_jump_out("continue", "Continue at top level.")
+            case ["return", value]: self._compile_return(value)
+            case ["tailcall", func, *args]:
+                self._compile_call(func, args, TAIL_CALL)
+                self._code.emit(RETURN)
+            case ["print", expr]:
+                self._compile_expr(expr)
+                self._code.emit(PRINT)
+            case ["expr", expr]:
+                self._compile_expr(expr)
+                self._code.emit(POP)
+            case unexpected: assert False, f"Internal Error at `{unexpected}`."
+
+    def _compile_block(self, names, statements):
+        self._code.emit(ENTER, self._code.constant(names))
+        self._block_depth += 1
+        for statement in statements: self._compile_statement(statement)
+        self._block_depth -= 1
+        self._code.emit(LEAVE, 1)
+
+    def _compile_store(self, depth, slot, value):
+        self._compile_expr(value)
+        self._compile_address(STORE_LOCAL, STORE_GLOBAL, STORE_DEREF, depth, slot)
+
+    def _compile_address(self, local, global_, deref, depth, slot):
+        if depth == 0: self._code.emit(local, slot)
+        elif depth == GLOBAL: self._code.emit(global_, slot)
+        else: self._code.emit(deref, self._code.constant((depth, slot)))
+
+    def _compile_if(self, cond, conseq, alt):
+        self._compile_expr(cond)
+        to_alt = self._code.emit(JUMP_IF_FALSE)
+        self._compile_statement(conseq)
+        if alt == ["seq"] and not self._count:
+            self._code.patch(to_alt, self._code.here())
+            return
+        to_end = self._code.emit(JUMP)
+        self._code.patch(to_alt, self._code.here())
+        self._compile_statement(alt)
+        self._code.patch(to_end, self._code.here())
+
+    def _compile_while(self, cond, body, then):
+        top = self._code.here()
+        self._compile_expr(cond)
+        to_then = self._code.emit(JUMP_IF_FALSE)
+        breaks = self._compile_loop_body(body, top)
+        self._code.emit(JUMP, top)
+        self._code.patch(to_then, self._code.here())
+        self._compile_statement(then)
+        for at in breaks: self._code.patch(at, self._code.here())
+
+    def _compile_for(self, init, cond, update, body):
+        self._compile_statement(init)
+        top = self._code.here()
+        self._compile_expr(cond)
+        to_end = self._code.emit(JUMP_IF_FALSE)
+        continues = []
+        breaks = self._compile_loop_body(body, continues)
+        for at in continues: self._code.patch(at, self._code.here())
+        self._compile_statement(update)
+        self._code.emit(JUMP, top)
+        for at in breaks + [to_end]: self._code.patch(at, self._code.here())
+
+    def _compile_loop_body(self, body, continue_target):
+        loop = {"depth": self._block_depth, "continue": continue_target, "break": []}
+        self._loops.append(loop)
+        self._compile_statement(body)
+        self._loops.pop()
+        return loop["break"]
+
+    def _compile_jump_out(self, kind, error):
+        if not self._loops:
+            self._code.emit(FAIL, self._code.constant(error))
+            return
+        loop = self._loops[-1]
+        if self._block_depth > loop["depth"]: self._code.emit(LEAVE, self._block_depth - loop["depth"])
+        target = loop[kind]
+        match target:
+            case int(top): self._code.emit(JUMP, top)
+            case list(jumps): jumps.append(self._code.emit(JUMP))
+
+    def _compile_return(self, value):
+        if not self._in_function:
+            self._code.emit(FAIL, self._code.constant("Return from top level."))
+            return
+        self._compile_expr(value)
+        self._code.emit(RETURN)
+
+    def _compile_expr(self, expr):
+        match expr:
+            case None | int() | bool(): self._code.emit(CONST, self._code.constant(expr))
+            case ["$get", depth, slot]: self._compile_address(LOAD_LOCAL, LOAD_GLOBAL, LOAD_DEREF, depth, slot)
+            case ["func", params, body, names, memo]:
+                self._code.emit(FUNC, self._code.constant(self._compile_function(params, body, names, memo)))
+            case ["-", a]:
+                self._compile_expr(a)
+                self._code.emit(NEG)
+            case [("^" | "*" | "/" | "+" | "-" | "<" | "<=" | ">" | ">=") as operator, a, b]:
+                self._compile_expr(a)
+                self._compile_expr(b)
+                self._code.emit(CALC, CALC_OPS.index(operator))
+            case [("=" | "#") as operator, a, b]:
+                self._compile_expr(a)
+                self._compile_expr(b)
+                self._code.emit(EQ if operator == "=" else NE)
+            case [("&" | "|") as operator, a, b]:
+                self._compile_expr(a)
+                to_end = self._code.emit(JUMP_IF_FALSE_OR_POP if operator == "&" else JUMP_IF_TRUE_OR_POP)
+                self._compile_expr(b)
+                self._code.patch(to_end, self._code.here())
+            case ["?", cond, conseq, alt]:
+                self._compile_expr(cond)
+                to_alt = self._code.emit(JUMP_IF_FALSE)
+                self._compile_expr(conseq)
+                to_end = self._code.emit(JUMP)
+                self._code.patch(to_alt, self._code.here())
+                self._compile_expr(alt)
+                self._code.patch(to_end, self._code.here())
+            case [func, *args]: self._compile_call(func, args, CALL)
+            case unexpected: assert False, f"Unexpected expression at `{unexpected}`."
+
+    def _compile_call(self, func, args, instruction):
+        self._compile_expr(func)
+        for arg in args: self._compile_expr(arg)
+        self._code.emit(instruction, len(args))
+
+class VirtualMachine(Evaluator):
+    # Calls of user functions push the caller's state onto a list of frames
+    # instead of recursing in Python, so recursion depth is bounded only by
+    # max_depth.
+
+    def __init__(self, max_depth=1000000, **options):
+        super().__init__(**options)
+        self._max_depth = max_depth
+        self._calc_ops = (op.pow, op.mul, self._div, op.add, op.sub, op.lt, op.le, op.gt, op.ge)
+
+    def _compile_program(self, program):
+        code = Compiler(self._source, self._count).compile_program(program)
+        return partial(self._execute, code)
+
+    def _execute(self, code, context):
+        # The running Code is kept along with its instructions so that an
+        # error can be located from it.
+        instructions, constants, calc_ops = code.instructions, code.constants, self._calc_ops
+        env = globals_ = context.globals
+        max_depth, output = self._max_depth, context.output
+        stack, envs, frames = [], [], []
+        push, pop = stack.append, stack.pop
+        pc, end = 0, len(instructions)
+        try:
+            while pc < end:
+                instruction, arg = instructions[pc], instructions[pc + 1]
+                pc += 2
+                if instruction == LOAD_LOCAL:
+                    value = env.values[arg]
+                    assert value is not UNDEFINED, f"`{env.names[arg]}` not defined."
+                    push(value)
+                elif instruction == LOAD_GLOBAL: push(globals_.get(arg))
+                elif instruction == CONST: push(constants[arg])
+                elif instruction == CALC:
+                    b, a = pop(), stack[-1]
+                    assert isinstance(a, int) and isinstance(b, int), f"Operands must be integers."
+                    stack[-1] = calc_ops[arg](a, b)
+                elif instruction == JUMP_IF_FALSE:
+                    if not pop(): pc = arg
+                elif instruction == JUMP: pc = arg
+                elif instruction == CALL or instruction == TAIL_CALL:
+                    args = stack[len(stack) - arg:]
+                    del stack[len(stack) - arg:]
+                    func = pop()
+                    if type(func) is Builtin:
+                        push(self._call_builtin(context, func, args, env))
+                        continue
+                    assert len(func.params) == len(args), f"Parameter's count doesn't match."
+                    if instruction == CALL:
+                        memo = None
+                        if func.memo is not None and (key := func.memo.key(args)) is not None:
+                            if (value := func.memo.lookup(key)) is not UNDEFINED:
+                                push(value)
+                                continue
+                            memo = func.memo, key
+                        assert len(frames) < max_depth, f"Stack overflow at depth {len(frames)}."
+                        frames.append((code, pc, env, envs, memo))
+                        envs = []
+                    else: envs.clear()
+                    code, env = func.code, func.new_frame(args)
+                    instructions, constants = code.instructions, code.constants
+                    pc, end = 0, len(instructions)
+                elif instruction == RETURN:
+                    if not frames: return pop()
+                    code, pc, env, envs, memo = frames.pop()
+                    instructions, constants, end = code.instructions, code.constants, len(code.instructions)
+                    if memo is not None: memo[0].store(memo[1], stack[-1])
+                elif instruction == EQ:
+                    b = pop()
+                    stack[-1] = stack[-1] == b
+                elif instruction == NE:
+                    b = pop()
+                    stack[-1] = stack[-1] != b
+                elif instruction == STORE_LOCAL: env.values[arg] = pop()
+                elif instruction == STORE_GLOBAL: globals_.assign(arg, pop())
+                elif instruction == POP: pop()
+                elif instruction == ENTER:
+                    envs.append(env)
+                    env = Environment(env, constants[arg])
+                elif instruction == LEAVE:
+                    env = envs[-arg]
+                    del envs[-arg:]
+                elif instruction == JUMP_IF_FALSE_OR_POP:
+                    if stack[-1]: pop()
+                    else: pc = arg
+                elif instruction == JUMP_IF_TRUE_OR_POP:
+                    if stack[-1]: pc = arg
+                    else: pop()
+                elif instruction == NEG:
+                    assert isinstance(stack[-1], int), f"Operand must be integer."
+                    stack[-1] = -stack[-1]
+                elif instruction == LOAD_DEREF:
+                    depth, slot = constants[arg]
+                    push(env.ancestor(depth).get(slot))
+                elif instruction == STORE_DEREF:
+                    depth, slot = constants[arg]
+                    env.ancestor(depth).assign(slot, pop())
+                elif instruction == FUNC:
+                    params, body, names, function_code, memo = constants[arg]
+                    push(Function(params, body, names, env, function_code, memo))
+                elif instruction == PRINT: output.append(self._to_print(pop()))
+                elif instruction == FAIL: assert False, constants[arg]
+                elif instruction == COUNT: context.statements += 1
+                else: assert False, f"Internal Error at `{instruction}`."
+        except AssertionError as e: raise code.locate(e, pc - 2)
+        return None
+
+    def _call_builtin(self, context, func, args, env):
+        assert func.arity == len(args), f"Parameter's count doesn't match."
+        context.env = env
+        return func.func(*args)
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+class BatchRunner:
+    # Runs one program over many sets of inputs in a pool of processes.
+    # Compiled code holds closures that cannot be pickled, so each worker
+    # is sent the source once and prepares it itself; bindings then go out
+    # in chunks, so that a chunk shares the cost of one round trip. run()
+    # gives (index, output) pairs, index counting bindings from 0 and output
+    # being what the run printed or the AssertionError it raised, in order
+    # or, with ordered=False, as chunks finish. Only a few chunks per worker
+    # are in flight at a time, so bindings may be a long or endless iterator.
+    # The program is prepared once here first, so one that does not parse
+    # or resolve fails with its error rather than in every worker.
+
+    _prepared = None
+
+    def __init__(self, text, inputs=(), filename="<input>", engine=Evaluator, make_parser=Parser,
+                 workers=None, chunk_size=256):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._setup = text, tuple(inputs), filename, engine, make_parser
+
+    def run(self, bindings, ordered=True):
+        BatchRunner._prepare(*self._setup)
+        chunks = self._chunks(bindings)
+        pool = ProcessPoolExecutor(self.workers, initializer=BatchRunner._start_worker, initargs=self._setup)
+        try:
+            pending = deque(pool.submit(BatchRunner._run_chunk, *chunk) for chunk in islice(chunks, 2 * self.workers))
+            while pending:
+                if ordered: done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done: pending.remove(future)
+                for future in done:
+                    if (chunk := next(chunks, None)) is not None: pending.append(pool.submit(BatchRunner._run_chunk, *chunk))
+                    yield from future.result()
+        finally: pool.shutdown(cancel_futures=True)
+
+    def _chunks(self, bindings):
+        bindings, start = iter(bindings), 0
+        while chunk := list(islice(bindings, self.chunk_size)):
+            yield start, chunk
+            start += len(chunk)
+
+    @staticmethod
+    def _start_worker(*setup):
+        BatchRunner._prepared = BatchRunner._prepare(*setup)
+
+    @staticmethod
+    def _prepare(text, inputs, filename, engine, make_parser):
+        parser = make_parser(text, filename=filename)
+        return engine().prepare(parser.parse_program(), parser.source, inputs)
+
+    @staticmethod
+    def _run_chunk(start, chunk):
+        results = []
+        for index, bindings in enumerate(chunk, start):
+            try: results.append((index, BatchRunner._prepared.run(bindings)))
+            except AssertionError as e: results.append((index, e))
+        return results
+
+import glob, time
+
+@dataclass(slots=True)
+class FileResult:
+    filename: str
+    output: list
+    error: Exception | None
+    seconds: float
+    statements: int
+    peak: int | None
+
+class FileBatch:
+    # Runs many source files in a pool of long-lived worker processes, each
+    # file once, and gives a FileResult per file in the order given: what
+    # it printed, the error that stopped it if any, its wall time, the
+    # statements it executed and the peak resident memory of its worker in
+    # KiB while it ran. The peak is reset through /proc before each file, so
+    # it is None where that cannot be done. engine and make_parser are
+    # factories, sent to each worker once.
+
+    _setup = None
+
+    def __init__(self, engine=Evaluator, make_parser=Parser, cache=True, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._setup_args = engine, make_parser, cache
+
+    @staticmethod
+    def expand(paths):
+        # A directory stands for the .minilang files under it and a pattern
+        # for the files it matches, each sorted; anything else is a file.
+        filenames = []
+        for path in paths:
+            if os.path.isdir(path): filenames += sorted(glob.glob(os.path.join(path, "**", "*.minilang"), recursive=True))
+            elif glob.has_magic(path): filenames += sorted(glob.glob(path, recursive=True))
+            else: filenames.append(path)
+        return filenames
+
+    def run(self, filenames):
+        with ProcessPoolExecutor(self.workers, initializer=FileBatch._start_worker, initargs=self._setup_args) as pool:
+            yield from pool.map(FileBatch._run_file, filenames)
+
+    @staticmethod
+    def _start_worker(engine, make_parser, cache):
+        FileBatch._setup = engine, make_parser, cache
+
+    @staticmethod
+    def _run_file(filename):
+        engine, make_parser, cache = FileBatch._setup
+        evaluator, error = engine(count=True), None
+        reset = FileBatch._reset_peak()
+        start = time.perf_counter()
+        try:
+            with open(filename, "r") as f:
+                if cache: program, source = AstCache(filename).parse(f, make_parser)
+                else:
+                    parser = make_parser(f, filename=filename)
+                    program, source = parser.parse_program(), parser.source
+                evaluator.eval_program(program, source)
+        except Exception as e: error = e
+        seconds = time.perf_counter() - start
+        return FileResult(filename, evaluator.output(), error, seconds, evaluator.statements, FileBatch._peak() if reset else None)
+
+    @staticmethod
+    def _reset_peak():
+        # Without the reset VmHWM is the worker's peak over all its files.
+        try:
+            with open("/proc/self/clear_refs", "w") as f: f.write("5")
+        except OSError: return False
+        return True
+
+    @staticmethod
+    def _peak():
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"): return int(line.split()[1])
+        except OSError: pass
+        return None
 
 if __name__ == "__main__":
-    import sys
+    import argparse
 
-    def run_from_file(filename):
-        evaluator = Evaluator()
+    ENGINES = {"tree": Evaluator, "closure": ClosureEvaluator, "arena": ArenaEvaluator, "vm": VirtualMachine}
+
+    SCANNERS = {"char": Scanner, "regex": RegexScanner}
+
+    PARSERS = {"recursive": Parser, "iterative": IterativeParser}
+
+    def error_message(e):
+        location = getattr(e, "location", None)
+        return str(e) if location is None else f"{location}: {e}"
+
+    def run_from_file(filename, evaluator, make_parser=Parser, cache=True):
         try:
-            with open(sys.argv[1], "r") as f:
-                evaluator.eval_program(Parser(f.read()).parse_program())
-        except AssertionError as e: print(e, file=sys.stderr)
+            with open(filename, "r") as f:
+                if cache: program, source = AstCache(filename).parse(f, make_parser)
+                else:
+                    parser = make_parser(f, filename=filename)
+                    program, source = parser.parse_program(), parser.source
+                evaluator.eval_program(program, source)
+        except AssertionError as e: print(error_message(e), file=sys.stderr)
         print(*evaluator.output(), sep="\n")
 
-    def repl():
-        evaluator = Evaluator()
-
+    def stream(file, filename, evaluator, make_parser=Parser):
+        parser = make_parser(file, filename=filename)
+        try:
+            for output in evaluator.eval_stream(parser.parse_statements(), parser.source):
+                if output: print(*output, sep="\n", flush=True)
+        except AssertionError as e: print(error_message(e), file=sys.stderr)
+        if output := evaluator.output(): print(*output, sep="\n")
+
+    def batch(paths, engine, make_parser=Parser, cache=True, workers=None):
+        runner = FileBatch(engine, make_parser, cache, workers)
+        rows, failed = [], 0
+        for result in runner.run(runner.expand(paths)):
+            print(f"==> {result.filename} <==", flush=True)
+            if result.output: print(*result.output, sep="\n", flush=True)
+            if result.error is not None:
+                failed += 1
+                print(error_message(result.error), file=sys.stderr, flush=True)
+            peak = "-" if result.peak is None else result.peak
+            rows.append((result.filename, "ok" if result.error is None else "error",
+                         f"{result.seconds * 1000:.1f}", result.statements, peak))
+        rows.append((f"{len(rows)} files", f"{failed} failed", f"{sum(float(row[2]) for row in rows):.1f}",
+                     sum(row[3] for row in rows), max((row[4] for row in rows if row[4] != "-"), default="-")))
+        header = ("file", "status", "ms", "statements", "peak KiB")
+        widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header))]
+        print()
+        for row in [header] + rows:
+            print(*(str(cell).ljust(width) if i < 2 else str(cell).rjust(width)
+                    for i, (cell, width) in enumerate(zip(row, widths))), sep="  ")
+        return failed
+
+    def repl(evaluator, make_parser=Parser):
+        # The parsed program is shown, so it is kept as lists or nodes.
+        cache = ParseCache(make_parser=partial(make_parser, arena=False))
         while True:
             print("Input source and enter Ctrl+D:")
             if (source := sys.stdin.read()) == "": break
 
             try:
-                ast = Parser(source).parse_program()
+                ast, source = cache.parse(source, "<stdin>")
                 print(ast)
                 evaluator.clear_output()
-                evaluator.eval_program(ast)
+                evaluator.eval_program(ast, source)
             except AssertionError as e:
-                print(e)
+                print(error_message(e))
             print("Output:", *evaluator.output(), sep="\n")
 
-    if len(sys.argv) > 1:
-        run_from_file(sys.argv[1])
+    arg_parser = argparse.ArgumentParser(prog="minilang")
+    arg_parser.add_argument("files", nargs="*", metavar="file", help="source file; with --batch, files, directories or glob patterns")
+    arg_parser.add_argument("--engine", choices=ENGINES, default="tree")
+    arg_parser.add_argument("--scanner", choices=SCANNERS, default="regex")
+    arg_parser.add_argument("--parser", choices=PARSERS, default="recursive")
+    arg_parser.add_argument("--max-nesting", type=int, help="parse stack allowed on the iterative parser")
+    arg_parser.add_argument("--nodes", action="store_true", help="build the syntax tree from node classes")
+    arg_parser.add_argument("--no-cache", action="store_true", help="neither read nor write the parsed file's .mlc cache")
+    arg_parser.add_argument("-O", "--optimize", action="store_true", help="fold constants before running")
+    arg_parser.add_argument("--memoize", action="store_true", help="cache results of pure functions")
+    arg_parser.add_argument("--memo-size", type=int, default=1024, help="entries kept per function cache")
+    arg_parser.add_argument("--max-depth", type=int, help="call depth allowed on the vm engine")
+    arg_parser.add_argument("--stream", action="store_true", help="run each statement as soon as it is read; reads stdin without a file")
+    arg_parser.add_argument("--batch", action="store_true", help="run each file in a pool of processes and summarize the runs")
+    arg_parser.add_argument("--workers", type=int, help="processes in the --batch pool; defaults to one per CPU")
+    args = arg_parser.parse_args()
+    if len(args.files) > 1 and not args.batch: arg_parser.error("more than one file needs --batch")
+    if args.batch and (args.stream or not args.files): arg_parser.error("--batch needs files and no --stream")
+    if args.workers is not None and not args.batch: arg_parser.error("--workers needs --batch")
+    file = args.files[0] if args.files else None
+
+    options = dict(optimize=args.optimize, memoize=args.memoize, memo_size=args.memo_size)
+    if args.max_depth is not None:
+        if args.engine != "vm": arg_parser.error("--max-depth needs --engine vm")
+        options["max_depth"] = args.max_depth
+    evaluator = ENGINES[args.engine](**options)
+    parser_options = dict(scanner=SCANNERS[args.scanner], nodes=args.nodes, arena=args.engine == "arena" and not args.stream)
+    if args.max_nesting is not None:
+        if args.parser != "iterative": arg_parser.error("--max-nesting needs --parser iterative")
+        parser_options["max_depth"] = args.max_nesting
+    make_parser = partial(PARSERS[args.parser], **parser_options)
+    if args.batch:
+        engine = partial(ENGINES[args.engine], **options)
+        sys.exit(1 if batch(args.files, engine, make_parser, not args.no_cache, args.workers) else 0)
+    elif args.stream and file is not None:
+        with open(file, "r") as f: stream(f, file, evaluator, make_parser)
+    elif args.stream:
+        stream(sys.stdin, "<stdin>", evaluator, make_parser)
+    elif file is not None:
+        run_from_file(file, evaluator, make_parser, not args.no_cache)
     else:
-        repl()
\ No newline at end of file
+        repl(evaluator, make_parser)
@@ -1,12 +1,26 @@
+import contextlib
+import io
+import os
+import tempfile
+import threading
 import unittest
+from functools import partial
+from unittest import mock
 
-from minilang import Parser, Evaluator
+from minilang import Token, Scanner, RegexScanner, SourceMap, Node, NodeConverter, Arena, Parser, IterativeParser, AstCache, ParseCache, Optimizer, Resolver, Evaluator, ClosureEvaluator, ArenaEvaluator, VirtualMachine, BatchRunner, FileBatch
 
-def get_ast(source): return Parser(source).parse_program()
+engine = Evaluator
+make_parser = Parser
+
+def get_ast(source):
+    match make_parser(source).parse_program():
+        case Node() as program: return NodeConverter().to_lists(program)
+        case Arena() as program: return program.to_lists()
+        case program: return program
 
 def get_output(source):
-    evaluator = Evaluator()
-    evaluator.eval_program(Parser(source).parse_program())
+    evaluator = engine()
+    evaluator.eval_program(make_parser(source).parse_program())
     return evaluator.output()
 
 def get_error(source):
@@ -14,6 +28,22 @@ def get_error(source):
     except AssertionError as e: return str(e)
     else: return f"Error not occurred. out={output}"
 
+def get_location(source):
+    parser = make_parser(source, filename="test.minilang")
+    try: engine().eval_program(parser.parse_program(), parser.source)
+    except AssertionError as e: return f"{e.location}: {e}"
+    else: return "Error not occurred."
+
+class Pipe(io.StringIO):
+    def seekable(self): return False
+
+def get_stream(source):
+    parser, outputs = make_parser(Pipe(source)), []
+    try:
+        for output in engine().eval_stream(parser.parse_statements(), parser.source): outputs.append(output)
+    except AssertionError as e: outputs.append(f"{getattr(e, 'location', None)}: {e}")
+    return outputs
+
 class TestMinilang(unittest.TestCase):
     def test_print(self):
         self.assertEqual(get_output("print 1;"), [1])
@@ -155,6 +185,54 @@ class TestMinilang(unittest.TestCase):
         self.assertEqual(get_error("less(1);"), "Parameter's count doesn't match.")
         self.assertEqual(get_error("less(1, 2, 3);"), "Parameter's count doesn't match.")
 
+    def test_register_builtin(self):
+        evaluator = engine()
+        evaluator.register_builtin("add3", 3, lambda a, b, c: a + b + c)
+        evaluator.eval_program(get_ast("print add3(1, 2, 3); print add3;"))
+        self.assertEqual(evaluator.output(), [6, "<builtin>"])
+        self.assertRaisesRegex(AssertionError, "Parameter's count doesn't match.",
+                               evaluator.eval_program, get_ast("add3(1, 2);"))
+        self.assertRaisesRegex(AssertionError, "`add3` already defined.",
+                               evaluator.register_builtin, "add3", 1, abs)
+
+    def test_memoize(self):
+        evaluator = engine(memoize=True)
+        evaluator.eval_program(get_ast("""
+                                       var fib = func(n) {
+                                           if n < 3 { return 1; }
+                                           return fib(n - 1) + fib(n - 2);
+                                       };
+                                       print fib(90);
+                                       """))
+        self.assertEqual(evaluator.output(), [2880067194370816120])
+        [cache] = evaluator.memo_caches()
+        self.assertEqual((cache.name, cache.misses, cache.hits), ("fib", 90, 87))
+
+        evaluator = engine(memoize=True)
+        evaluator.eval_program(get_ast("""
+                                       var k = 1; var m = 1;
+                                       def f(n) { return n + k; }
+                                       def g(n) { print n; return n; }
+                                       def h(n) { return f(n) + 1; }
+                                       def apply(f, n) { return f(n); }
+                                       def sq(n) { var r = n * n; return r; }
+                                       def is_even(a) { return a = 0 ? true : is_odd(a - 1); }
+                                       def is_odd(a) { return a = 0 ? false : is_even(a - 1); }
+                                       def add_m(n) { return n + m; }
+                                       def mk(n) { return func() { return n; }; }
+                                       set k = 2;
+                                       print add_m(1);
+                                       print mk(1) = mk(1);
+                                       """))
+        self.assertEqual([cache.name for cache in evaluator.memo_caches()], ["sq", "is_even", "is_odd", "add_m", "mk"])
+        evaluator.eval_program(get_ast("set m = 5; print add_m(1);"))
+        self.assertEqual(evaluator.output(), [2, "false", 6])
+
+        evaluator = engine(memoize=True, memo_size=2)
+        evaluator.eval_program(get_ast("def sq(n) { return n * n; } print sq(1) + sq(2) + sq(3) + sq(1) + sq(3);"))
+        [cache] = evaluator.memo_caches()
+        self.assertEqual((evaluator.output(), cache.misses, cache.hits, len(cache)), ([24], 4, 1, 2))
+
     def test_gcd(self):
         self.assertEqual(get_output("""
                                     var a = 36; var b = 24; var tmp = 0;
@@ -324,6 +402,61 @@ class TestMinilang(unittest.TestCase):
                                     """), [1, 3, 4, 10])
         self.assertEqual(get_error("continue;"), "Continue at top level.")
 
+    def test_break_continue_scope(self):
+        self.assertEqual(get_output("""
+                                    var n = 0;
+                                    while true {
+                                        var a = n;
+                                        { var b = a; if b = 2 { break; } }
+                                        set n = n + 1;
+                                        if n = 1 { continue; }
+                                        print a;
+                                    }
+                                    var a = 10; var b = 20;
+                                    print a + b;
+                                    """), [1, 30])
+
+    def test_resolver(self):
+        self.assertEqual(get_error("var f = func() { return a; };"), "`a` not defined.")
+        self.assertEqual(get_error("var f = func(a, a) {};"), "`a` already defined.")
+        self.assertEqual(get_error("if false { var a = 1; var a = 2; }"), "`a` already defined.")
+        self.assertEqual(get_output("var a = 1; { print a; var a = 2; print a; } print a;"), [1, 2, 1])
+        self.assertEqual(get_output("var f = func() { return g(); }; var g = func() { return 3; }; print f();"), [3])
+        self.assertEqual(get_error("{ var f = func() { return b; }; print f(); var b = 1; }"), "`b` not defined.")
+        self.assertEqual(get_output("""
+                                    var a = 1;
+                                    var f = func(b) { return func(c) { { { return a + b + c; } } }; };
+                                    print f(2)(3);
+                                    """), [6])
+
+        evaluator = engine()
+        with self.assertRaises(AssertionError): evaluator.eval_program(get_ast("print 1; print a;"))
+        self.assertEqual(evaluator.output(), [])
+
+    def test_frames(self):
+        self.assertEqual(get_output("print func(a) { var a = a + 1; return a; }(1);"), [2])
+        self.assertEqual(get_output("def f(a) { { { var a = a + 1; { return func() { return a; }; } } } } print f(1)();"), [2])
+        self.assertEqual(get_output("""
+                                    var f = null; var g = null;
+                                    for i = 0; i # 2; i = i + 1 {
+                                        var x = i * 10;
+                                        if i = 0 { set f = func() { return x; }; } else { set g = func() { return x; }; }
+                                    }
+                                    print f(); print g();
+                                    """), [0, 10])
+
+    def test_globals_persist(self):
+        evaluator = engine()
+        evaluator.eval_program(get_ast("var a = 1; def f() { return a; }"))
+        evaluator.eval_program(get_ast("set a = 2; print f();"))
+        self.assertEqual(evaluator.output(), [2])
+
+    def test_completions(self):
+        self.assertEqual(get_output("def f() { while true { for i = 0; true; i = i + 1 { if i = 3 { return i; } } } } print f();"), [3])
+        self.assertEqual(get_output("while true { while true { break; } then { print 1; } print 2; break; } then { print 3; }"), [2])
+        self.assertEqual(get_error("while true { func() { break; }(); }"), "Break at top level.")
+        self.assertEqual(get_error("func() { continue; }();"), "Continue at top level.")
+
     def test_def(self):
         self.assertEqual(get_output("""
                                     def sum(a, b) {
@@ -382,5 +515,415 @@ class TestMinilang(unittest.TestCase):
 
         self.assertEqual(get_error("print 1 # 1 ? 1 + 2;"), "Expected `:`, found `;`.")
 
+    def test_precedence(self):
+        self.assertEqual(get_ast("print a | b & c = d < e + f * -g ^ h ^ i(j) ? k : l;"),
+                         ["program", ["print", ["?", ["|", "a", ["&", "b", ["=", "c", ["<", "d", ["+", "e",
+                             ["*", "f", ["^", ["-", "g"], ["^", "h", ["i", "j"]]]]]]]]], "k", "l"]]])
+        self.assertEqual(get_ast("print a - b - c < d # e ? f : g ? h : i;"),
+                         ["program", ["print", ["?", ["#", ["<", ["-", ["-", "a", "b"], "c"], "d"], "e"], "f", ["?", "g", "h", "i"]]]])
+        self.assertEqual(get_ast("print " + "(" * 200 + "1" + ")" * 200 + ";"), ["program", ["print", 1]])
+
+    def test_tail_call(self):
+        self.assertEqual(get_output("""
+                                    def sum(n, acc) { if n = 0 { return acc; } return sum(n - 1, acc + n); }
+                                    def even(n) { if n = 0 { return true; } return odd(n - 1); }
+                                    def odd(n) { if n = 0 { return false; } return even(n - 1); }
+                                    def loop(n) { while true { for i = 0; i < 2; i = i + 1 { if n = 0 { return 0; } return loop(n - 1); } } }
+                                    def count(n) { { var m = n - 1; if m < 0 { return n; } return count(m); } }
+                                    print sum(10000, 0); print even(5001); print loop(3000); print count(3000);
+                                    def lt(a, b) { return less(a, b); }
+                                    print lt(1, 2);
+                                    """), [50005000, "false", 0, 0, "true"])
+        self.assertEqual(get_error("def f(n) { return f(); } f(1);"), "Parameter's count doesn't match.")
+        self.assertEqual(get_error("return less(1, 2);"), "Return from top level.")
+
+    def test_unreachable_errors(self):
+        self.assertEqual(get_error("print 1 / (2 - 2);"), "Division by zero.")
+        self.assertEqual(get_error("print false ? 1 : -null * 1;"), "Operand must be integer.")
+        self.assertEqual(get_error("if false { print c; }"), "`c` not defined.")
+        self.assertEqual(get_error("def f() { return 1; var a = 1; var a = 2; }"), "`a` already defined.")
+
+    def test_print_env_alias(self):
+        evaluator, printed = engine(), io.StringIO()
+        evaluator.eval_program(get_ast("var p = print_env;"))
+        with contextlib.redirect_stdout(printed):
+            evaluator.eval_program(get_ast("def f(a) { var b = 2; { var c = 3; p(); } } f(1);"))
+        self.assertEqual(printed.getvalue().splitlines()[1:], ["{'a': 1}", "{'b': 2}", "{'c': 3}"])
+        evaluator, printed = engine(), io.StringIO()
+        evaluator.eval_program(get_ast("var p = null; def f(a) { var b = 1; var a = 2; p(); } def g() { p(); }"))
+        with contextlib.redirect_stdout(printed): evaluator.eval_program(get_ast("set p = print_env; f(1); g();"))
+        self.assertEqual(printed.getvalue().splitlines()[1:3] + printed.getvalue().splitlines()[4:],
+                         ["{'a': 1}", "{'b': 1, 'a': 2}", "{}", "{}"])
+
+    def test_failed_program(self):
+        evaluator = engine()
+        with self.assertRaises(AssertionError): evaluator.eval_program(get_ast("print 1 / 0; var a = 1;"))
+        evaluator.eval_program(get_ast("var a = 2; print a;"))
+        self.assertEqual(evaluator.output(), [2])
+        with self.assertRaises(AssertionError) as raised: evaluator.eval_program(get_ast("var a = 3;"))
+        self.assertEqual(str(raised.exception), "`a` already defined.")
+
+    def test_prepare(self):
+        evaluator = engine()
+        prepared = evaluator.prepare(get_ast("var t = n * 2; def f(x) { return x + n; } print f(t); print less(n, m);"), inputs=["n", "m"])
+        self.assertEqual(prepared.inputs, ("n", "m"))
+        self.assertEqual([prepared.run({"n": n, "m": 2}) for n in (1, 2, 3)], [[3, "true"], [6, "false"], [9, "false"]])
+        with self.assertRaises(AssertionError) as raised: prepared.run({"n": 1})
+        self.assertEqual(str(raised.exception), "`m` not defined.")
+        with self.assertRaises(AssertionError) as raised: prepared.run({"n": 1, "k": 2})
+        self.assertEqual(str(raised.exception), "`k` is not an input.")
+        evaluator.eval_program(get_ast("print 1;"))
+        self.assertEqual(evaluator.output(), [1])
+        self.assertEqual(prepared.run({"n": 0, "m": 1}), [0, "true"])
+        memoized = Evaluator(memoize=True).prepare(get_ast("def f(x) { return x + n; } print f(1);"), inputs=["n"])
+        self.assertEqual([memoized.run({"n": n}) for n in (1, 2)], [[2], [3]])
+        memoized = engine(memoize=True).prepare(get_ast("var t = n * 2; def f(x) { return x + t; } print f(1);"), inputs=["n"])
+        self.assertEqual([memoized.run({"n": n}) for n in (1, 2, 3)], [[3], [5], [7]])
+        evaluator.eval_program(get_ast("var t = 5; var n = t + 1; print n;"))
+        self.assertEqual(evaluator.output(), [1, 6])
+        self.assertEqual(prepared.run({"n": 1, "m": 2}), [3, "true"])
+
+    def test_threads(self):
+        prepared = engine().prepare(get_ast("def f(k) { if k = 0 { return 1 / n; } { var a = f(k - 1); return a + n; } }\n"
+                                            "var i = 0; while i < 3 { print f(n); set i = i + 1; }"), inputs=["n"])
+        wrong = []
+        def run(first):
+            for n in range(first, first + 100):
+                try: output = prepared.run({"n": n % 7})
+                except AssertionError as e: output = str(e)
+                if output != ([n % 7 * (n % 7) + 1 // (n % 7)] * 3 if n % 7 else "Division by zero."): wrong.append(n)
+        threads = [threading.Thread(target=run, args=(first,)) for first in range(0, 400, 100)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(wrong, [])
+
+    def test_count(self):
+        evaluator = engine(count=True)
+        evaluator.eval_program(get_ast("def g(n) { var a = 0; for i = 0; i < n; i = i + 1 { if i = 2 { continue; } "
+                                       "while a < i { set a = a + 1; break; } then { print 0; } } return h(a); }\n"
+                                       "def h(x) { { return x; } }\nprint g(4);"))
+        self.assertEqual((evaluator.output(), evaluator.statements), ([0, 2], 39))
+        evaluator = engine()
+        evaluator.eval_program(get_ast("print 1;"))
+        self.assertEqual(evaluator.statements, 0)
+
+    def test_error_location(self):
+        self.assertEqual(get_location("print 1;\nprint 1 +\n  2 3;"), "test.minilang:3:5: Expected `;`, found `3`.")
+        self.assertEqual(get_location("var x = 1;\nvar x = 2;"), "test.minilang:2:1: `x` already defined.")
+        self.assertEqual(get_location("var a = 1;\nif a {\n  while a { print y; }\n}"), "test.minilang:3:13: `y` not defined.")
+        self.assertEqual(get_location("print 1;\n  print 1 / 0;"), "test.minilang:2:3: Division by zero.")
+        self.assertEqual(get_location("def f(n) {\n  return 1 / n;\n}\nprint f(f(1) - 1);"),
+                         "test.minilang:2:3: Division by zero.")
+        self.assertEqual(get_location("def g(n) { return n ? g(n - 1) : -null; }\ng(3);"),
+                         "test.minilang:1:12: Operand must be integer.")
+        self.assertEqual(get_location("for i = 0; i < 3; i = i + null {\n  print i;\n}"),
+                         "test.minilang:1:1: Operands must be integers.")
+
+    def test_stream(self):
+        self.assertEqual(get_stream("print 1; var a = 2;\nwhile a { print a; set a = a - 1; }\n"), [[1], [], [2, 1]])
+        self.assertEqual(get_stream("def f(n) { return g(n) + 1; }\ndef g(n) { return n * 2; }\nprint f(3);"), [[], [], [7]])
+        self.assertEqual(get_stream("def f() { return h(); }\nprint 1;"), [[], [1], "None: `h` not defined."])
+        self.assertEqual(get_stream("print 1;\n{ print 2;\n  print 1 / 0; }"), [[1], "<input>:3:3: Division by zero."])
+        self.assertEqual(get_stream("print g;\nvar g = 1;"), ["<input>:1:1: `g` not defined."])
+
+class TestScanner(unittest.TestCase):
+    def tokens(self, scanner, source):
+        scanner, tokens = scanner(source), []
+        while (token := scanner.next_token()) != "$EOF": tokens.append(token)
+        return tokens
+
+    def test_regex_scanner(self):
+        for source in ["var a_1=12;print a_1<=3>=4<5>6 ! comment\r\nnull true false", "x! comment at end",
+                       "\t\x0b\x0c\x1c 1 ?:,#&|$@ \x1f", "12ab ab12 (){}", "var é = 1;", ""]:
+            self.assertEqual(self.tokens(RegexScanner, source), self.tokens(Scanner, source))
+        self.assertEqual(self.tokens(RegexScanner, "a<=b!c\nnull"), ["a", "<=", "b", None])
+        self.assertEqual(Parser("def f(a) { return a >= 0; }", Scanner).parse_program(), get_ast("def f(a) { return a >= 0; }"))
+
+    def test_token_stream(self):
+        for scanner in (Scanner, RegexScanner):
+            tokens = scanner("var x1 = 10; ! note\nprint x1<=null;").scan()
+            self.assertEqual([Token.TEXTS[kind] for kind in tokens.kinds],
+                             ["var", "name", "=", "number", ";", "print", "name", "<=", "null", ";", "$EOF"])
+            self.assertEqual(list(tokens.starts), [0, 4, 7, 9, 11, 20, 26, 28, 30, 34, 35])
+            self.assertEqual(list(tokens.lengths), [3, 2, 1, 2, 1, 5, 2, 2, 4, 1, 0])
+            self.assertEqual(tokens.literals, {1: "x1", 3: 10, 6: "x1"})
+            self.assertEqual([tokens.value(index) for index in range(len(tokens))],
+                             ["var", "x1", "=", 10, ";", "print", "x1", "<=", None, ";", "$EOF"])
+
+    def test_chunked_source(self):
+        source = "var abc = 123; ! a comment\r\nprint abc <= 4;\n! last\rprint é;"
+        for scanner in (Scanner, RegexScanner):
+            expected = scanner(source).scan()
+            for size in (1, 2, 5, 16):
+                chunked = scanner(io.StringIO(source, newline=""))
+                chunked.CHUNK_SIZE = size
+                tokens = chunked.scan()
+                self.assertEqual((tokens.kinds, tokens.starts, tokens.lengths, tokens.literals),
+                                 (expected.kinds, expected.starts, expected.lengths, expected.literals))
+        parser = Parser(io.StringIO("print 1;\nprint 2 3;"), filename="a.minilang")
+        with self.assertRaises(AssertionError) as raised: parser.parse_program()
+        self.assertEqual(raised.exception.location, "a.minilang:2:9")
+
+    def test_parse_statements(self):
+        source = Pipe("print 1;\nprint\n 2; if true {\n} \nelse { }\nprint 3;")
+        statements = Parser(source).parse_statements()
+        self.assertEqual((next(statements), source.tell()), (["print", 1], 9))
+        self.assertEqual((next(statements), source.tell()), (["print", 2], 29))
+        self.assertEqual((next(statements), source.tell()), (["if", True, ["block"], ["block"]], 49))
+        self.assertEqual(list(statements), [["print", 3]])
+        self.assertEqual(Parser(io.StringIO("print 1;\nprint 2;")).parse_program(), ["program", ["print", 1], ["print", 2]])
+
+    def test_iterative_parser(self):
+        for source in ["var a = 1; set a = -(a + 2) * f(a)(1, 2) ^ 2 ^ 3;",
+                       "if a { print 1; } elif b { print 2; } elif c { } else { var x = 0; }",
+                       "while a < 10 { break; continue; } for i = 0; i < 3; i = i + 1 { print i; }",
+                       "def f(a, b) { return func(x) { return x ? a : b; }; } print - - 1 # 2 | 3 & 4;",
+                       "{ { } } print null; f();"]:
+            self.assertEqual(IterativeParser(source).parse_program(), get_ast(source))
+        depth = 5000
+        for source, head in [("print " + "(" * depth + "1" + ")" * depth + ";", "print"),
+                             ("{" * depth + "}" * depth, "block"),
+                             ("if a { } " + "elif a { } " * depth + "else { }", "if"),
+                             ("print " + "-" * depth + "1;", "print")]:
+            node, count = IterativeParser(source).parse_program()[1], 0
+            while isinstance(node, list) and node[0] == head: node, count = node[-1], count + 1
+            self.assertGreater(count, 0)
+        parser = IterativeParser("print 1;\nprint ((((1));", filename="a.minilang", max_depth=8)
+        with self.assertRaises(AssertionError) as raised: parser.parse_program()
+        self.assertEqual(f"{raised.exception.location}: {raised.exception}", "a.minilang:2:9: Nesting deeper than 8.")
+        deep = "{" * depth + "}" * depth
+        for evaluator in (Evaluator(), ClosureEvaluator(), ArenaEvaluator(), VirtualMachine()):
+            with self.assertRaises(AssertionError) as raised: evaluator.eval_program(IterativeParser(deep).parse_program())
+            self.assertEqual(str(raised.exception), "Nesting too deep.")
+        with self.assertRaises(AssertionError) as raised: IterativeParser(deep, nodes=True).parse_program()
+        self.assertEqual(str(raised.exception), "Nesting too deep.")
+        with self.assertRaises(AssertionError) as raised: get_output("def f(n) { return n = 0 ? 0 : 1 + f(n - 1); } print f(5000);")
+        self.assertEqual(str(raised.exception), "Stack overflow.")
+
+    def test_source_map(self):
+        source = SourceMap("ab\ncd\r\n\nef", "a.minilang")
+        self.assertEqual([source.position(offset) for offset in (0, 1, 3, 5, 7, 8, 10)],
+                         [(1, 1), (1, 2), (2, 1), (2, 3), (3, 1), (4, 1), (4, 3)])
+        self.assertEqual(source.locate(AssertionError("x"), 4).location, "a.minilang:2:2")
+
+class TestAstCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "a.minilang")
+
+    def tearDown(self): self.directory.cleanup()
+
+    def parse(self, text, make_parser=Parser):
+        with open(self.filename, "w") as f: f.write(text)
+        with open(self.filename) as f:
+            program, source = AstCache(self.filename).parse(f, make_parser)
+            evaluator = Evaluator()
+            try: evaluator.eval_program(program, source)
+            except AssertionError as e: return program, f"{e.location}: {e}"
+            return program, evaluator.output()
+
+    def test_cache(self):
+        def fail(*args, **kwargs): self.fail("Parsed again.")
+        text = "def f() {\n  print 1;\n  return 1 / 0;\n}\nprint f();"
+        expected = (get_ast(text), f"{self.filename}:3:3: Division by zero.")
+        self.assertEqual(self.parse(text, partial(Parser, nodes=True)), expected)
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, "a.mlc")))
+        self.assertEqual(self.parse(text, fail), expected)
+        self.assertEqual(self.parse("print 2;"), (get_ast("print 2;"), [2]))
+        with open(os.path.join(self.directory.name, "a.mlc"), "r+b") as f: f.truncate(60)
+        self.assertEqual(self.parse("print 2;"), (get_ast("print 2;"), [2]))
+        self.assertEqual(self.parse("print 2;", fail), (get_ast("print 2;"), [2]))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["a.minilang", "a.mlc"])
+
+    def test_too_deep(self):
+        text = "{" * 3000 + "}" * 3000 + "print 1;"
+        with open(self.filename, "w") as f: f.write(text)
+        with open(self.filename) as f: program, _ = AstCache(self.filename).parse(f, IterativeParser)
+        self.assertEqual(program[-1], ["print", 1])
+        self.assertEqual(os.listdir(self.directory.name), ["a.minilang"])
+
+class TestParseCache(unittest.TestCase):
+    def test_parse_cache(self):
+        cache = ParseCache(size=2)
+        first, source = cache.parse("print 1;\nprint x;", "a.minilang")
+        self.assertEqual(first, get_ast("print 1;\nprint x;"))
+        for _ in range(2):
+            program, source = cache.parse("print 1;\nprint x;", "a.minilang")
+            self.assertIs(program, first)
+            with self.assertRaises(AssertionError) as raised: Evaluator().eval_program(program, source)
+            self.assertEqual(raised.exception.location, "a.minilang:2:1")
+        cache.parse("print 2;")
+        cache.parse("print 3;")
+        self.assertIsNot(cache.parse("print 1;\nprint x;", "a.minilang")[0], first)
+        self.assertEqual((len(cache), cache.hits, cache.misses, cache.evictions), (2, 2, 4, 2))
+
+    def test_arena(self):
+        cache = ParseCache(make_parser=partial(Parser, arena=True))
+        for evaluator in (ArenaEvaluator(), ArenaEvaluator(), ArenaEvaluator(memoize=True)):
+            program, source = cache.parse("print 1;\nprint 1 / 0;", "a.minilang")
+            with self.assertRaises(AssertionError) as raised: evaluator.eval_program(program, source)
+            self.assertEqual(raised.exception.location, "a.minilang:2:1")
+            self.assertEqual(program.source.marks, {})
+
+    def test_threads(self):
+        cache, sources, wrong = ParseCache(size=3), [f"print {n} + 1;" for n in range(5)], []
+        def parse():
+            for n in range(200):
+                if cache.parse(sources[n % 5])[0] != get_ast(sources[n % 5]): wrong.append(n)
+        threads = [threading.Thread(target=parse) for _ in range(4)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual((wrong, len(cache), cache.hits + cache.misses), ([], 3, 800))
+
+class TestBatchRunner(unittest.TestCase):
+    def test_batch(self):
+        runner = BatchRunner("def f(x) { return x * n; }\nprint f(2) / m;", ["n", "m"], "a.minilang",
+                             engine=ClosureEvaluator, workers=2, chunk_size=3)
+        bindings = [{"n": n, "m": n % 4} for n in range(10)]
+        results = list(runner.run(iter(bindings)))
+        self.assertEqual([index for index, _ in results], list(range(10)))
+        self.assertEqual([output for _, output in results if not isinstance(output, AssertionError)],
+                         [[n * 2 // (n % 4)] for n in range(10) if n % 4])
+        self.assertEqual([f"{output.location}: {output}" for _, output in results if isinstance(output, AssertionError)],
+                         ["a.minilang:2:1: Division by zero."] * 3)
+        self.assertEqual(sorted(runner.run(bindings[1:4], ordered=False)), [(0, [2]), (1, [2]), (2, [2])])
+        self.assertEqual([str(output) for _, output in runner.run([{"n": 1, "m": 1}, {"k": 1}, {"n": 2, "m": 1}])],
+                         ["[2]", "`k` is not an input.", "[4]"])
+
+    def test_bad_program(self):
+        for text, message in [("print (n;", "a.minilang:1:9: Expected `)`, found `;`."),
+                              ("print n;\nprint x;", "a.minilang:2:1: `x` not defined.")]:
+            with self.assertRaises(AssertionError) as raised: list(BatchRunner(text, ["n"], "a.minilang", workers=2).run([{"n": 1}]))
+            self.assertEqual(f"{raised.exception.location}: {raised.exception}", message)
+
+class TestFileBatch(unittest.TestCase):
+    def setUp(self): self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self): self.directory.cleanup()
+
+    def test_batch(self):
+        os.mkdir(os.path.join(self.directory.name, "sub"))
+        for name, text in [("a.minilang", "print 1 + 2;"), ("sub/b.minilang", "print 5;\nprint 1 / 0;"), ("c.txt", "print 3;")]:
+            with open(os.path.join(self.directory.name, name), "w") as f: f.write(text)
+        batch = FileBatch(engine=VirtualMachine, cache=False, workers=2)
+        filenames = batch.expand([self.directory.name, os.path.join(self.directory.name, "*.txt"), "missing.minilang"])
+        self.assertEqual(filenames, [os.path.join(self.directory.name, name) for name in ["a.minilang", "sub/b.minilang", "c.txt"]]
+                         + ["missing.minilang"])
+        results = list(batch.run(filenames))
+        self.assertEqual([result.filename for result in results], filenames)
+        self.assertEqual([(result.output, result.statements) for result in results], [([3], 1), ([5], 2), ([3], 1), ([], 0)])
+        self.assertEqual([str(result.error) for result in results[:3]], ["None", "Division by zero.", "None"])
+        self.assertEqual(results[1].error.location, f"{filenames[1]}:2:1")
+        self.assertIsInstance(results[3].error, FileNotFoundError)
+        self.assertTrue(all(result.seconds >= 0 for result in results))
+
+    def test_peak_not_reset(self):
+        filename = os.path.join(self.directory.name, "a.minilang")
+        with open(filename, "w") as f: f.write("print 1;")
+        FileBatch._start_worker(Evaluator, Parser, False)
+        try:
+            with mock.patch.object(FileBatch, "_reset_peak", return_value=False): result = FileBatch._run_file(filename)
+        finally: FileBatch._setup = None
+        self.assertEqual((result.output, result.peak), ([1], None))
+
+class TestResolver(unittest.TestCase):
+    def test_frames(self):
+        self.assertEqual(Resolver(["less"]).resolve_program(get_ast("def f(a) { var b = a; { print b; } }")),
+                         ["program", ["var", 1, ["func", ["a"], ["seq", ["var", 1, ["$get", 0, 0]], ["seq", ["print", ["$get", 0, 1]]]], ("a", "b"), None]]])
+        self.assertEqual(Resolver(["print_env"]).resolve_program(get_ast("def f(a) { { print_env(); } }")),
+                         ["program", ["var", 1, ["func", ["a"], ["block", (), ["block", (), ["expr", [["$get", -1, 0]]]]], ("a",), None]]])
+
+    def test_tail_call(self):
+        self.assertEqual(Resolver([]).resolve_program(get_ast("def f(a) { return f(a - 1); } return f(1);")),
+                         ["program", ["var", 0, ["func", ["a"], ["seq", ["tailcall", ["$get", -1, 0], ["-", ["$get", 0, 0], 1]]], ("a",), None]],
+                          ["return", [["$get", -1, 0], 1]]])
+
+class TestOptimizer(unittest.TestCase):
+    def optimize(self, source): return Optimizer().optimize_program(Resolver(["a", "b"]).resolve_program(get_ast(source)))
+
+    def test_fold(self):
+        self.assertEqual(self.optimize("print -(2 ^ 3 * 4 - 6 / 2) < 0 & 1 = 1;"), ["program", ["print", True]])
+        self.assertEqual(self.optimize("print 0 ? a : b | a;"), ["program", ["print", ["|", ["$get", -1, 1], ["$get", -1, 0]]]])
+        self.assertEqual(self.optimize("print 1 / 0; print 2 ^ -1; print -null;"),
+                         ["program", ["print", ["/", 1, 0]], ["print", ["^", 2, -1]], ["print", ["-", None]]])
+        self.assertEqual(self.optimize("print a * 1; print (a + 1) * 1 + 0; print --(a - b); print 1 * a();"),
+                         ["program", ["print", ["*", ["$get", -1, 0], 1]], ["print", ["+", ["$get", -1, 0], 1]],
+                          ["print", ["-", ["$get", -1, 0], ["$get", -1, 1]]], ["print", ["*", 1, [["$get", -1, 0]]]]])
+
+    def test_statements(self):
+        self.assertEqual(self.optimize("if 1 < 2 { print a; } else { print b; }"), ["program", ["seq", ["print", ["$get", -1, 0]]]])
+        self.assertEqual(self.optimize("while false { print a; } then { print b; }"), ["program", ["seq", ["print", ["$get", -1, 1]]]])
+        self.assertEqual(self.optimize("for i = 0; false; i = i + 1 { print i; }"), ["program", ["var", 2, 0]])
+        self.assertEqual(self.optimize("def f() { 1 + 2; return 3; print 4; }"),
+                         ["program", ["var", 2, ["func", [], ["seq", ["return", 3]], (), None]]])
+
+class Variant:
+    # Runs the tests of TestMinilang again with the engine and make_parser
+    # given as class attributes.
+    engine = Evaluator
+    make_parser = Parser
+
+    def setUp(self):
+        global engine, make_parser
+        engine, make_parser = self.engine, self.make_parser
+
+    def tearDown(self):
+        global engine, make_parser
+        engine, make_parser = Evaluator, Parser
+
+class TestOptimizedEvaluator(Variant, TestMinilang):
+    engine = partial(Evaluator, optimize=True)
+
+class TestClosureEvaluator(Variant, TestMinilang):
+    engine = ClosureEvaluator
+
+class TestNodeAst(Variant, TestMinilang):
+    make_parser = partial(Parser, nodes=True)
+
+    def test_nodes(self):
+        source = """var a = -1; set a = a + 2 * 3; def f(x, y) { return x ? f(y)(1) : null; }
+                    if a { break; } elif true { continue; } else { print f; }
+                    for i = 0; i < 3; i = i + 1 { while a { f(); } then { } }"""
+        program = Parser(source, nodes=True).parse_program()
+        self.assertIsInstance(program, Node)
+        self.assertFalse(hasattr(program, "__dict__"))
+        self.assertEqual(NodeConverter().to_lists(program), Parser(source).parse_program())
+        self.assertEqual(NodeConverter().to_nodes(Parser(source).parse_program()), program)
+        self.assertEqual(IterativeParser(source, nodes=True).parse_program(), program)
+
+class TestArenaEvaluator(Variant, TestMinilang):
+    engine = ArenaEvaluator
+    make_parser = partial(Parser, arena=True)
+
+    def test_arena(self):
+        source = """def f(a, b) { var c = -a - b; for i = 0; i < 3; i = i + 1 { while c { break; } then { continue; } } }
+                    print expr(block(1)) ? 2 ^ 100 ^ 2 : null; if 1 { } elif 2 { } else { print true; }"""
+        arena = Parser(source, arena=True).parse_program()
+        self.assertEqual(arena.to_lists(), Parser(source).parse_program())
+        self.assertEqual([arena.kinds.typecode, arena.first_children.typecode, arena.next_siblings.typecode, arena.operands.typecode], ["q"] * 4)
+        self.assertEqual(arena.constants.count("b"), 1)
+        resolved = Resolver(["expr", "block"]).resolve_program(Parser(source).parse_program())
+        flat = Arena()
+        self.assertEqual(flat.to_lists(flat.add(resolved, True)), resolved)
+
+class TestVirtualMachine(Variant, TestMinilang):
+    engine = VirtualMachine
+
+    def test_deep_recursion(self):
+        source = "def sum(n) { if n = 0 { return 0; } return n + sum(n - 1); } print sum(20000);"
+        self.assertEqual(get_output(source), [200010000])
+        evaluator = VirtualMachine(memoize=True)
+        evaluator.eval_program(get_ast(source))
+        self.assertEqual(evaluator.output(), [200010000])
+        self.assertEqual(evaluator.memo_caches()[0].misses, 20001)
+
+        evaluator = VirtualMachine(max_depth=100)
+        evaluator.eval_program(get_ast("def f(n) { if n = 0 { return 0; } return 1 + f(n - 1); } print f(99);"))
+        try: evaluator.eval_program(get_ast("print f(100);"))
+        except AssertionError as e: self.assertEqual(str(e), "Stack overflow at depth 100.")
+        else: self.fail("Error not occurred.")
+        evaluator.eval_program(get_ast("def g(n) { if n = 0 { return 0; } return g(n - 1); } print g(1000);"))
+        self.assertEqual(evaluator.output(), [99, 0])
+
 if __name__ == "__main__":
     unittest.main()